@@ -0,0 +1,201 @@
+import json
+import os
+import re
+import shutil
+import tempfile
+import numpy as np
+
+from functools import lru_cache
+from hashlib import sha1
+from typing import Any, Callable, Iterable, List, Optional
+
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+def default_preprocessing_func(text: str) -> List[str]:
+    return text.split()
+
+# Identifiers and numbers. Everything else (`::`, `.`, `/`, `<>`, operators, ...) separates them.
+_IDENTIFIER_RE = re.compile(r'[A-Za-z_][A-Za-z0-9_]*|[0-9]+')
+# Words of a camelCase or PascalCase identifier, keeping acronyms (`HTTPServer` -> `HTTP`, `Server`).
+_WORD_RE = re.compile(r'[A-Z]+(?=[A-Z][a-z])|[A-Z]?[a-z]+|[A-Z]+|[0-9]+')
+
+@lru_cache(maxsize=1 << 16)
+def split_identifier(identifier: str) -> tuple[str, ...]:
+    '''
+    Splits an identifier into its lowercase snake_case/camelCase words, followed by
+    the whole identifier if it has several words, e.g. `getFooBar` into `get`, `foo`,
+    `bar`, `getfoobar`.
+    '''
+    words = [w.lower() for part in identifier.split('_') for w in _WORD_RE.findall(part)]
+    if len(words) > 1:
+        words.append(identifier.lower().replace('_', ''))
+    return tuple(words)
+
+class CodeTokenizer:
+    '''
+    Tokenizer of source code for lexical retrieval, shared by index build and query:
+    splits paths and generics apart, splits identifiers with `split_identifier`, and
+    drops language `keywords` and single characters.
+    '''
+    def __init__(self, keywords: Iterable[str]=()):
+        self.keywords = frozenset(keywords)
+
+    def __call__(self, text: str) -> List[str]:
+        tokens = []
+        for identifier in _IDENTIFIER_RE.findall(text):
+            if identifier in self.keywords:
+                continue
+            tokens.extend([w for w in split_identifier(identifier) if len(w) > 1])
+        return tokens
+
+class BM25Index:
+    '''
+    Okapi BM25 over an inverted index stored as NumPy arrays: the postings of term `t`
+    are `doc_ids[indptr[t]:indptr[t+1]]` with frequencies `tfs[...]`. Scores match
+    `rank_bm25.BM25Okapi` (same IDF and epsilon floor), so the two are interchangeable.
+    Saved indices are memory-mapped when loaded.
+    '''
+    FILES = ['indptr', 'doc_ids', 'tfs', 'idf', 'norms']
+
+    def __init__(self, vocab: dict[str, int], indptr, doc_ids, tfs, idf, norms, k1=1.5):
+        self.vocab = vocab
+        self.indptr = indptr
+        self.doc_ids = doc_ids
+        self.tfs = tfs
+        self.idf = idf
+        # Per-document length normalization `k1 * (1 - b + b * len / avgdl)`.
+        self.norms = norms
+        self.k1 = k1
+
+    @classmethod
+    def build(cls, corpus: Iterable[List[str]], k1=1.5, b=0.75, epsilon=0.25) -> 'BM25Index':
+        vocab: dict[str, int] = {}
+        postings: list[dict[int, int]] = []
+        doc_lens = []
+        for doc_id, tokens in enumerate(corpus):
+            doc_lens.append(len(tokens))
+            for token in tokens:
+                term = vocab.setdefault(token, len(vocab))
+                if term == len(postings):
+                    postings.append({})
+                postings[term][doc_id] = postings[term].get(doc_id, 0) + 1
+        doc_lens = np.asarray(doc_lens, dtype=np.float64)
+        dfs = np.asarray([len(p) for p in postings], dtype=np.int64)
+        indptr = np.zeros(len(postings) + 1, dtype=np.int64)
+        np.cumsum(dfs, out=indptr[1:])
+        doc_ids = np.fromiter((d for p in postings for d in p), dtype=np.int32, count=indptr[-1])
+        tfs = np.fromiter((tf for p in postings for tf in p.values()), dtype=np.float32, count=indptr[-1])
+        n_docs = len(doc_lens)
+        idf = np.log(n_docs - dfs + 0.5) - np.log(dfs + 0.5)
+        if len(idf) > 0:
+            idf[idf < 0] = epsilon * idf.mean()
+        avgdl = doc_lens.mean() if n_docs > 0 else 1
+        norms = k1 * (1 - b + b * doc_lens / avgdl)
+        return cls(vocab, indptr, doc_ids, tfs, idf, norms, k1)
+
+    def save(self, directory: str):
+        '''
+        Saves the index into `directory` atomically, keeping an index already saved there.
+        '''
+        os.makedirs(os.path.dirname(os.path.abspath(directory)), exist_ok=True)
+        tmp = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(directory)))
+        for name in self.FILES:
+            np.save(os.path.join(tmp, f'{name}.npy'), getattr(self, name))
+        with open(os.path.join(tmp, 'vocab.json'), 'w') as f:
+            json.dump({'k1': self.k1, 'vocab': self.vocab}, f)
+        try:
+            os.rename(tmp, directory)
+        except OSError:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    @classmethod
+    def load(cls, directory: str) -> 'BM25Index':
+        with open(os.path.join(directory, 'vocab.json'), 'r') as f:
+            meta = json.load(f)
+        arrays = [np.load(os.path.join(directory, f'{name}.npy'), mmap_mode='r') for name in cls.FILES]
+        return cls(meta['vocab'], *arrays, k1=meta['k1'])
+
+    def __len__(self) -> int:
+        return len(self.norms)
+
+    def scores(self, query: List[str]) -> np.ndarray:
+        '''
+        Returns the BM25 score of every document. Repeated query tokens count repeatedly.
+        '''
+        scores = np.zeros(len(self), dtype=np.float64)
+        for token in query:
+            term = self.vocab.get(token)
+            if term is None:
+                continue
+            start, end = self.indptr[term], self.indptr[term + 1]
+            docs, tfs = self.doc_ids[start:end], self.tfs[start:end]
+            # Document ids are unique within a posting list, so fancy-index addition is exact.
+            scores[docs] += self.idf[term] * tfs * (self.k1 + 1) / (tfs + self.norms[docs])
+        return scores
+
+    def top_k(self, query: List[str], k: int) -> np.ndarray:
+        '''
+        Returns the ids of the `k` best scoring documents, best first, with the higher id
+        first among equal scores. `rank_bm25` may order ties differently: its argsort is
+        not stable, and its scores can differ in the last bits.
+        '''
+        scores = self.scores(query)
+        k = min(k, len(scores))
+        if k == 0:
+            return np.zeros(0, dtype=np.int64)
+        kth = np.partition(scores, len(scores) - k)[len(scores) - k]
+        above = np.flatnonzero(scores > kth)
+        ties = np.flatnonzero(scores == kth)[::-1][:k - len(above)]
+        top = np.concatenate([above, ties])
+        return top[np.lexsort((-top, -scores[top]))]
+
+class NumpyBM25Retriever(BaseRetriever):
+    '''
+    Drop-in replacement of `BM25Retriever` backed by a `BM25Index`, e.g. as a member
+    of an `EnsembleRetriever`.
+    '''
+    index: Any
+    docs: List[Document]
+    k: int = 4
+    preprocess_func: Callable[[str], List[str]] = default_preprocessing_func
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    @classmethod
+    def from_documents(cls, documents: Iterable[Document], *,
+                       persist_directory: Optional[str]=None,
+                       preprocess_func: Callable[[str], List[str]]=default_preprocessing_func,
+                       bm25_params: Optional[dict]=None,
+                       **kwargs: Any) -> 'NumpyBM25Retriever':
+        '''
+        - `persist_directory`, where indices are saved, under a digest of the documents.
+          An index of the same documents is loaded (memory-mapped) instead of being
+          rebuilt, so the directory must be specific to `preprocess_func` and `bm25_params`.
+        '''
+        docs = list(documents)
+        directory = None
+        if persist_directory is not None:
+            digest = sha1()
+            for doc in docs:
+                digest.update(doc.page_content.encode() + b'\0')
+            directory = os.path.join(persist_directory, digest.hexdigest())
+        if directory is not None and os.path.isdir(directory):
+            index = BM25Index.load(directory)
+        else:
+            index = BM25Index.build([preprocess_func(doc.page_content) for doc in docs], **(bm25_params or {}))
+            if directory is not None:
+                index.save(directory)
+        return cls(index=index, docs=docs, preprocess_func=preprocess_func, **kwargs)
+
+    def top_k(self, query: str, k: int=None) -> List[Document]:
+        '''
+        Returns the `k` (defaults to `self.k`) best scoring documents, best first.
+        '''
+        return [self.docs[i] for i in self.index.top_k(self.preprocess_func(query), k or self.k)]
+
+    def _get_relevant_documents(self, query: str, *,
+                                run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        return self.top_k(query)
@@ -0,0 +1,49 @@
+import json
+import os
+import sqlite3
+
+from hashlib import sha1, sha256
+
+class CompletionCache:
+    '''
+    On-disk prompt -> completion store. Completions are keyed by the sampling
+    configuration, the prompt hash and the sample index, so that reruns and
+    ablations sharing the same prompts do not query the model again.
+    '''
+    def __init__(self, path='./.completion_cache.db'):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS completions ('
+                          'config TEXT, prompt TEXT, idx INTEGER, completion TEXT, '
+                          'PRIMARY KEY (config, prompt, idx))')
+        self.conn.commit()
+
+    @staticmethod
+    def config_key(model_id: str, temp: float, top_p: float, max_new_tokens: int, stop: list[str]) -> str:
+        config = [model_id, temp, top_p, max_new_tokens, stop]
+        return sha1(json.dumps(config).encode()).hexdigest()
+
+    @staticmethod
+    def prompt_key(prompt: str) -> str:
+        return sha256(prompt.encode()).hexdigest()
+
+    def get(self, config: str, prompt: str, n: int) -> list[str | None]:
+        '''
+        Returns the cached completions for sample indices [0, n), `None` for misses.
+        '''
+        rows = self.conn.execute('SELECT idx, completion FROM completions '
+                                 'WHERE config = ? AND prompt = ? AND idx < ?',
+                                 (config, self.prompt_key(prompt), n)).fetchall()
+        ans = [None] * n
+        for idx, completion in rows:
+            ans[idx] = completion
+        return ans
+
+    def put(self, config: str, prompt: str, completions: dict[int, str]):
+        key = self.prompt_key(prompt)
+        self.conn.executemany('INSERT OR REPLACE INTO completions VALUES (?, ?, ?, ?)',
+                              [(config, key, idx, completion) for idx, completion in completions.items()])
+        self.conn.commit()
@@ -0,0 +1,88 @@
+import java.io.BufferedReader;
+import java.io.File;
+import java.io.FileDescriptor;
+import java.io.FileOutputStream;
+import java.io.InputStreamReader;
+import java.io.PrintStream;
+import java.io.StringWriter;
+import java.net.URL;
+import java.net.URLClassLoader;
+import java.util.Arrays;
+import java.util.List;
+
+import javax.tools.JavaCompiler;
+import javax.tools.StandardJavaFileManager;
+import javax.tools.ToolProvider;
+
+import org.junit.runner.JUnitCore;
+import org.junit.runner.Request;
+
+/**
+ * Long-running test harness for JavaEval candidates of one Defects4J checkout.
+ *
+ * Usage: java -cp harness:libs TestHarness classesDir testClassesDir compileClasspath sourceLevel
+ *
+ * The project and test classes must not be on the harness classpath, they are loaded
+ * by a fresh class loader for every request, after the recompiled focal class.
+ *
+ * Requests are read from stdin, one per line, tab separated:
+ *   TEST  source file  output dir  class::method[,class::method...]
+ * Responses are written to stdout, one per line:
+ *   COMPILE_ERROR  message | COMPILED, then PASS|FAIL  class::method, then END
+ */
+public class TestHarness {
+    public static void main(String[] args) throws Exception {
+        PrintStream proto = new PrintStream(new FileOutputStream(FileDescriptor.out), true, "UTF-8");
+        // keep output of the tests away from the protocol
+        System.setOut(System.err);
+        URL classes = new File(args[0]).toURI().toURL();
+        URL testClasses = new File(args[1]).toURI().toURL();
+        String classpath = args[2];
+        String level = args[3];
+        JavaCompiler compiler = ToolProvider.getSystemJavaCompiler();
+        BufferedReader in = new BufferedReader(new InputStreamReader(System.in, "UTF-8"));
+        String line;
+        while ((line = in.readLine()) != null) {
+            String[] req = line.split("\t", -1);
+            if (req.length != 4 || !req[0].equals("TEST")) {
+                proto.println("END");
+                continue;
+            }
+            File out = new File(req[2]);
+            out.mkdirs();
+            StringWriter diagnostics = new StringWriter();
+            boolean compiled;
+            try (StandardJavaFileManager fm = compiler.getStandardFileManager(null, null, null)) {
+                List<String> options = Arrays.asList("-nowarn", "-proc:none", "-encoding", "UTF-8",
+                                                     "-source", level, "-target", level,
+                                                     "-cp", classpath, "-d", out.getPath());
+                compiled = compiler.getTask(diagnostics, fm, null, options, null,
+                                            fm.getJavaFileObjects(new File(req[1]))).call();
+            }
+            if (!compiled) {
+                proto.println("COMPILE_ERROR\t" + diagnostics.toString().replace('\n', ' ').replace('\t', ' '));
+                proto.println("END");
+                continue;
+            }
+            proto.println("COMPILED");
+            URLClassLoader loader = new URLClassLoader(new URL[] { out.toURI().toURL(), classes, testClasses },
+                                                       TestHarness.class.getClassLoader());
+            Thread.currentThread().setContextClassLoader(loader);
+            for (String test : req[3].isEmpty() ? new String[0] : req[3].split(",")) {
+                String[] parts = test.split("::");
+                boolean pass;
+                try {
+                    Class<?> cls = Class.forName(parts[0], true, loader);
+                    Request request = parts.length > 1 ? Request.method(cls, parts[1]) : Request.aClass(cls);
+                    pass = new JUnitCore().run(request).wasSuccessful();
+                } catch (Throwable t) {
+                    pass = false;
+                }
+                proto.println((pass ? "PASS\t" : "FAIL\t") + test);
+            }
+            Thread.currentThread().setContextClassLoader(TestHarness.class.getClassLoader());
+            loader.close();
+            proto.println("END");
+        }
+    }
+}
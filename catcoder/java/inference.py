@@ -1,10 +1,13 @@
+import asyncio
 import os
 
 import backoff
 from dotenv import load_dotenv
 
+from completion_cache import CompletionCache
+
 try:
-    from openai import OpenAI, RateLimitError
+    from openai import OpenAI, AsyncOpenAI, RateLimitError
 except ImportError:
     print('Please install the openai package')
 try:
@@ -16,19 +19,101 @@ if os.path.exists('.env'):
     load_dotenv('.env', override=True)
 
 class Model:
-    def __init__(self, model_id: str, temp: float, top_p: float, **kwargs):
+    '''
+    Base class for models. Subclasses implement `_infer_n` (and optionally
+    `_ainfer_n`/`_infer_batch`), the public `infer*` methods consult the
+    completion cache before calling them.
+    '''
+    def __init__(self, model_id: str, temp: float, top_p: float, 
+                 concurrency=1, stream=False, completion_cache: str=None, **kwargs):
+        '''
+        - `concurrency`, max number of requests in flight in `infer_batch` for
+          client-side models. Values > 1 switch them to the asyncio client.
+        - `stream`, whether client-side models stream tokens back. Only useful
+          for interactive use, batch evaluation should keep the single response.
+        - `completion_cache`, path of the on-disk completion cache, disabled if `None`.
+        '''
         self.model_id = model_id
         self.temp = temp
         self.top_p = top_p
         self.max_new_tokens = 512
+        self.stop = []
+        self.concurrency = concurrency
+        self.stream = stream
+        self._loop = asyncio.new_event_loop() if concurrency > 1 else None
+        self.completion_cache = CompletionCache(completion_cache) if completion_cache is not None else None
 
     @property
     def info(self) -> str:
         return f'{self.model_id}_temp{self.temp}_topp{self.top_p}'
+
+    @property
+    def cache_key(self) -> str:
+        return CompletionCache.config_key(self.model_id, self.temp, self.top_p, 
+                                          self.max_new_tokens, self.stop)
     
     def infer(self, prompt: str) -> str:
+        return self.infer_n(prompt, 1)[0]
+
+    def infer_n(self, prompt: str, n: int) -> list[str]:
+        '''
+        Sample `n` completions for the same prompt. Backends that support
+        multiple choices per request share one prefill and one round trip.
+        '''
+        return self.infer_batch([prompt], n)[0]
+
+    def infer_batch(self, prompts: list[str], n: int) -> list[list[str]]:
+        '''
+        Sample `n` completions for each prompt, results are in the order of `prompts`.
+        Only the samples missing from the completion cache are requested, once per
+        distinct prompt, so repeated prompts share their cached samples.
+        '''
+        if self.completion_cache is None:
+            return self._infer_batch(prompts, n)
+
+        config = self.cache_key
+        unique = list(dict.fromkeys(prompts))
+        results = [self.completion_cache.get(config, prompt, n) for prompt in unique]
+        # group prompts by the number of missing samples, so each group is one backend call
+        groups: dict[int, list[int]] = {}
+        for idx, result in enumerate(results):
+            missing = result.count(None)
+            if missing > 0:
+                groups.setdefault(missing, []).append(idx)
+        for missing, indices in groups.items():
+            generated = self._infer_batch([unique[idx] for idx in indices], missing)
+            for idx, completions in zip(indices, generated):
+                slots = [i for i, r in enumerate(results[idx]) if r is None]
+                new = dict(zip(slots, completions))
+                for slot, completion in new.items():
+                    results[idx][slot] = completion
+                self.completion_cache.put(config, unique[idx], new)
+        by_prompt = dict(zip(unique, results))
+        return [list(by_prompt[prompt]) for prompt in prompts]
+
+    def _infer_n(self, prompt: str, n: int) -> list[str]:
+        raise NotImplementedError()
+
+    async def _ainfer_n(self, prompt: str, n: int) -> list[str]:
         raise NotImplementedError()
 
+    def _infer_batch(self, prompts: list[str], n: int) -> list[list[str]]:
+        '''
+        Offline engines should override this to schedule all prompts at once.
+        '''
+        if self._loop is not None:
+            return self._loop.run_until_complete(self._ainfer_batch(prompts, n))
+        return [self._infer_n(prompt, n) for prompt in prompts]
+
+    async def _ainfer_batch(self, prompts: list[str], n: int) -> list[list[str]]:
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def _bounded(prompt):
+            async with semaphore:
+                return await self._ainfer_n(prompt, n)
+
+        return list(await asyncio.gather(*[_bounded(prompt) for prompt in prompts]))
+
     @staticmethod
     def new(**kwargs) -> 'Model':
         if 'gpt' in kwargs['model_id']:
@@ -46,27 +131,56 @@ class OpenAIModel(Model):
             'gpt-3.5': 'gpt-3.5-turbo-0125',
             'gpt-4': 'gpt-4-turbo-preview',
         }
-        super().__init__(full_ids[model_id], temp, top_p)
+        super().__init__(full_ids[model_id], temp, top_p, **kwargs)
+        self.stop = ['[/CODE]', '/**']
         self.client = OpenAI(api_key=os.environ['OPENAI_API_KEY'], 
                              base_url=os.environ['OPENAI_BASE_URL'])
-        
-    @backoff.on_exception(backoff.expo, RateLimitError)
-    def infer(self, prompt: str) -> str:
-        task = self.client.chat.completions
-        completion = task.create(
+        if self._loop is not None:
+            self.aclient = AsyncOpenAI(api_key=os.environ['OPENAI_API_KEY'], 
+                                       base_url=os.environ['OPENAI_BASE_URL'])
+
+    def _request(self, prompt: str, n: int) -> dict:
+        return dict(
             model=self.model_id,
             messages=[{'role': 'system', 'content': 'You are an expert at Java programming.'}, {'role': 'user', 'content': prompt}],
-            stream=True,
+            stream=self.stream,
+            n=n,
             temperature=self.temp,
             top_p=self.top_p,
-            stop=['[/CODE]', '/**'],
+            stop=self.stop,
             max_tokens=self.max_new_tokens,
         )
-        ans = ''
+        
+    def _texts(self, choices, n: int) -> list[str]:
+        ans = [''] * n
+        for choice in choices:
+            ans[choice.index] = choice.message.content or ''
+        return ans
+
+    @backoff.on_exception(backoff.expo, RateLimitError)
+    def _infer_n(self, prompt: str, n: int) -> list[str]:
+        completion = self.client.chat.completions.create(**self._request(prompt, n))
+        if not self.stream:
+            return self._texts(completion.choices, n)
+        ans = [''] * n
         for chunk in completion:
-            content = chunk.choices[0].delta.content
-            if content is not None:
-                ans += content
+            for choice in chunk.choices:
+                content = choice.delta.content
+                if content is not None:
+                    ans[choice.index] += content
+        return ans
+
+    @backoff.on_exception(backoff.expo, RateLimitError)
+    async def _ainfer_n(self, prompt: str, n: int) -> list[str]:
+        completion = await self.aclient.chat.completions.create(**self._request(prompt, n))
+        if not self.stream:
+            return self._texts(completion.choices, n)
+        ans = [''] * n
+        async for chunk in completion:
+            for choice in chunk.choices:
+                content = choice.delta.content
+                if content is not None:
+                    ans[choice.index] += content
         return ans
 
 class VllmModel(Model):
@@ -80,7 +194,8 @@ class VllmModel(Model):
                  quantization: str=None,
                  **kwargs
                  ):
-        super().__init__(model_id, temp, top_p)
+        super().__init__(model_id, temp, top_p, **kwargs)
+        self.stop = ['[/CODE]', '/**', 'public', 'private']
         if gpu_ordinals is not None:
             os.environ['CUDA_VISIBLE_DEVICES'] = ','.join(map(str, gpu_ordinals))
             num_gpus = min(num_gpus, len(gpu_ordinals))
@@ -90,22 +205,33 @@ class VllmModel(Model):
                          quantization=quantization,
                          dtype=dtype,
                          )
-        self.sampling_params = SamplingParams(temperature=temp,
-                                              top_p=self.top_p,
-                                              stop=['[/CODE]', '/**', 'public', 'private'],
-                                              max_tokens=self.max_new_tokens,
-                                              )
 
-    def infer(self, prompt: str) -> str:
+    def _sampling_params(self, n: int) -> 'SamplingParams':
+        return SamplingParams(n=n,
+                              temperature=self.temp,
+                              top_p=self.top_p,
+                              stop=self.stop,
+                              max_tokens=self.max_new_tokens,
+                              )
+
+    def _infer_n(self, prompt: str, n: int) -> list[str]:
         response = self.model.generate(prompt, 
-                                       self.sampling_params, use_tqdm=False)[0]
-        return response.outputs[0].text
+                                       self._sampling_params(n), use_tqdm=False)[0]
+        return [output.text for output in response.outputs]
+
+    def _infer_batch(self, prompts: list[str], n: int) -> list[list[str]]:
+        responses = self.model.generate(prompts, 
+                                        self._sampling_params(n), use_tqdm=True)
+        return [[output.text for output in response.outputs] for response in responses]
 
 class VllmClientModel(Model):
     def __init__(self, model_id: str, port=3000, mock=False, temp=0.6, top_p=0.7, **kwargs):
-        super().__init__(model_id, temp, top_p)
+        super().__init__(model_id, temp, top_p, **kwargs)
+        self.stop = ['[/CODE]', '/**', 'public', 'private']
         if not mock:
             self.client = OpenAI(api_key='EMPTY', base_url=f'http://localhost:{port}/v1')
+            if self._loop is not None:
+                self.aclient = AsyncOpenAI(api_key='EMPTY', base_url=f'http://localhost:{port}/v1')
             self._models = self.client.models.list()
             for model in self._models.data:
                 if model.id == model_id:
@@ -115,21 +241,45 @@ class VllmClientModel(Model):
                 self._model = self._models.data[0].id
             print(f'user-side model_id: {model_id}, server-side model_id: {self._model}')
 
-    def infer(self, prompt: str) -> str:
-        task = self.client.completions
-        completion = task.create(
+    def _request(self, prompt: str, n: int) -> dict:
+        return dict(
             model=self._model,
             prompt=prompt,
             echo=False,
-            stream=True,
+            stream=self.stream,
+            n=n,
             temperature=self.temp,
             top_p=self.top_p,
-            stop=['[/CODE]', '/**', 'public', 'private'],
+            stop=self.stop,
             max_tokens=self.max_new_tokens,
         )
-        ans = ''
+
+    def _texts(self, choices, n: int) -> list[str]:
+        ans = [''] * n
+        for choice in choices:
+            ans[choice.index] = choice.text or ''
+        return ans
+
+    def _infer_n(self, prompt: str, n: int) -> list[str]:
+        completion = self.client.completions.create(**self._request(prompt, n))
+        if not self.stream:
+            return self._texts(completion.choices, n)
+        ans = [''] * n
         for chunk in completion:
-            content = chunk.choices[0].text
-            if content is not None:
-                ans += content
+            for choice in chunk.choices:
+                content = choice.text
+                if content is not None:
+                    ans[choice.index] += content
+        return ans
+
+    async def _ainfer_n(self, prompt: str, n: int) -> list[str]:
+        completion = await self.aclient.completions.create(**self._request(prompt, n))
+        if not self.stream:
+            return self._texts(completion.choices, n)
+        ans = [''] * n
+        async for chunk in completion:
+            for choice in chunk.choices:
+                content = choice.text
+                if content is not None:
+                    ans[choice.index] += content
         return ans
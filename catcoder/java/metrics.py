@@ -1,9 +1,15 @@
-import multiprocessing as mp
+import json
+import os
+import threading
+import time
 import numpy as np
 
+from concurrent.futures import ProcessPoolExecutor, Future, as_completed
 from functools import lru_cache
+from hashlib import sha1
 
-from test_adapter import TestAdapter
+from test_adapter import TestAdapter, limit_worker, wait_for_load
+from util import load_jsonl, append_jsonl, normalize_code
 
 class Metric:
     @property
@@ -16,8 +22,42 @@ class Metric:
     def to_dict(self) -> dict:
         raise NotImplementedError()
 
+# Generous time limits for measuring the reference solution of a project.
+CALIBRATION_TIMEOUTS = {'compile': 600, 'test': 600}
+
+def _run_adapter_mp(args):
+    data, runner, timeouts, max_load = args
+    if max_load is not None:
+        wait_for_load(max_load)
+    start = time.perf_counter()
+    with TestAdapter(data, runner, timeouts) as adapter:
+        adapter.test()
+    return adapter.outcome, time.perf_counter() - start
+
 class CratePassK(Metric):
-    def __init__(self, n: int, k: int | list[int], fn_codes: list[list[str]], data):
+    def __init__(self, n: int, k: int | list[int], fn_codes: list[list[str]], data, checkpoint: str=None, resume=True, 
+                 workers: int=None, history: str=None, runner='defects4j', budgets: str=None, 
+                 timeout_factor: float=5, min_timeout: float=10, threads_per_worker: int=None, 
+                 memory_per_worker: int=None, max_load: float=None):
+        '''
+        - `fn_codes`, generated code of each task. Entries may be filled in later
+          when tasks are evaluated incrementally with `evaluate_task`.
+        - `checkpoint`, JSONL file recording per-task results as they are computed.
+        - `resume`, whether to reuse results in `checkpoint` whose code is unchanged.
+        - `workers`, size of the process pool shared by all test jobs, defaults to the CPU count.
+        - `history`, JSON file of per-task test durations from previous runs, used to
+          schedule the slowest tasks first. It is updated as tasks complete.
+        - `runner`, how candidates are tested, see `TestAdapter`.
+        - `budgets`, JSON file of per-project time limits of each `runner`. Projects missing
+          from it are calibrated by testing their reference solution, and each measured
+          stage gets `timeout_factor` times its duration (at least `min_timeout` seconds).
+          Without it the defaults of `TestAdapter` apply.
+        - `threads_per_worker`, CPUs each JVM of a worker sizes its threads for, defaults to
+          an even split of the CPUs among the workers.
+        - `memory_per_worker`, maximum heap of each JVM of a worker in MiB.
+        - `max_load`, jobs only start while the 1-minute load average is below it
+          (or after waiting for a while), see `wait_for_load`.
+        '''
         self.n = n
         if isinstance(k, int):
             self.k = [k]
@@ -26,47 +66,233 @@ class CratePassK(Metric):
         assert all([self.n >= _k and _k > 0 for _k in self.k])
 
         self.data = data
+        self.runner = runner
         self.fn_codes = fn_codes
         self.case_cnt = len(self.fn_codes)
+        self.checkpoint = checkpoint
+        self.resume = resume
+        self.counts: dict[int, tuple[int, int]] = {}
+        self.outcomes: dict[int, list[dict]] = {}
+        self._lock = threading.Lock()
+        self._checkpointed = self._load_checkpoint()
+        self.workers = workers or os.cpu_count()
+        self.threads_per_worker = threads_per_worker or max(1, os.cpu_count() // self.workers)
+        self.memory_per_worker = memory_per_worker
+        self.max_load = max_load
+        self._pool = None
+        self.builds = 0
+        self.saved_builds = 0
+        self.history = history
+        self._durations: dict[str, float] = {}
+        if history is not None and os.path.exists(history):
+            with open(history, 'r') as f:
+                self._durations = json.load(f)
+        self.budgets = budgets
+        self.timeout_factor = timeout_factor
+        self.min_timeout = min_timeout
+        self._budget_lock = threading.Lock()
+        self._budgets: dict[str, dict[str, float]] = {}
+        if budgets is not None and os.path.exists(budgets):
+            with open(budgets, 'r') as f:
+                self._budgets = json.load(f)
+
+    @property
+    def pool(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(self.workers, initializer=limit_worker, 
+                                                 initargs=(self.threads_per_worker, self.memory_per_worker))
+            return self._pool
+
+    def close(self):
+        '''
+        Shuts down the shared worker pool, waiting for running jobs.
+        '''
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+            self._pool = None
 
-    def _run_adapter_mp(self, data):
-        with TestAdapter(data) as adapter:
-            adapter.test()
-            return adapter.compile_success, adapter.test_success
+    def __enter__(self) -> 'CratePassK':
+        return self
 
-    def _compile_pass_cnt(self, data, fn_codes: list[str]):
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    @staticmethod
+    def _codes_hash(fn_codes: list[str]) -> str:
+        return sha1(json.dumps(fn_codes).encode()).hexdigest()
+
+    def _load_checkpoint(self) -> dict[int, tuple[str, int, int, list[dict]]]:
+        if self.checkpoint is None:
+            return {}
+        if not self.resume:
+            if os.path.exists(self.checkpoint):
+                os.remove(self.checkpoint)
+            return {}
+        return {r['idx']: (r['codes'], r['compiles'], r['passes'], r.get('outcomes', [])) 
+                for r in load_jsonl(self.checkpoint)}
+
+    def _restore(self, i: int) -> bool:
         '''
-        Returns the number of compilable/passing test cases for one task in the benchmark.
+        Restores the counts of task `i` from the checkpoint if its code is unchanged.
+        '''
+        if i in self.counts:
+            return True
+        if i in self._checkpointed and self._checkpointed[i][0] == self._codes_hash(self.fn_codes[i]):
+            _, cc, pc, outcomes = self._checkpointed[i]
+            self.counts[i] = (cc, pc)
+            self.outcomes[i] = outcomes
+            print(f'Case {i} (checkpointed): {pc}/{self.n} passed, {cc}/{self.n} compiled.')
+            return True
+        return False
+
+    def _calibrate(self, indices: list[int]):
+        '''
+        Learns the time limits of the projects of tasks `indices` that have no budget yet
+        in the current `mode`, by testing their reference solutions concurrently with
+        generous limits.
+        '''
+        if self.budgets is None:
+            return
+        with self._budget_lock:
+            references = {}
+            for i in indices:
+                project = self.data[i]['package']
+                if self.mode not in self._budgets.get(project, {}) and project not in references:
+                    references[project] = self.pool.submit(_run_adapter_mp, 
+                                                           self._job(self.data[i].copy(), CALIBRATION_TIMEOUTS))
+            if not references:
+                return
+            for project, future in references.items():
+                outcome, _ = future.result()
+                if outcome['status'] != 'pass':
+                    print(f'Reference solution of {project} did not pass ({outcome["status"]}), '
+                          'falling back to the default time limits.')
+                    self._budgets.setdefault(project, {})[self.mode] = {}
+                    continue
+                budget = {stage: max(self.min_timeout, self.timeout_factor * duration) 
+                          for stage, duration in outcome['durations'].items()}
+                self._budgets.setdefault(project, {})[self.mode] = budget
+                print(f'Time limits of {project} ({self.mode}): {budget}')
+            with open(self.budgets, 'w') as f:
+                json.dump(self._budgets, f, indent=2)
+
+    @property
+    def mode(self) -> str:
         '''
-        args = []
+        How candidates are tested, time limits are learned per mode.
+        '''
+        return self.runner
+
+    def _timeouts(self, i: int) -> dict | None:
+        if self.budgets is None:
+            return None
+        return self._budgets.get(self.data[i]['package'], {}).get(self.mode)
+
+    def _job(self, data, timeouts: dict) -> tuple:
+        return data, self.runner, timeouts, self.max_load
+
+    def _submit(self, i: int) -> list[tuple[Future, int]]:
+        '''
+        Submits one test job per unique generated candidate of task `i` to the shared pool.
+        Returns the jobs along with the number of candidates each one stands for.
+        '''
+        fn_codes = self.fn_codes[i]
+        assert len(fn_codes) == self.n
+        # Candidates are grouped by their normalized code, and the first original
+        # candidate of each group is the one tested.
+        uniques: dict[str, list] = {}
         for code in fn_codes:
-            _data = data.copy()
+            uniques.setdefault(normalize_code(code), [code, 0])[1] += 1
+        with self._lock:
+            self.builds += len(uniques)
+            self.saved_builds += self.n - len(uniques)
+        self._calibrate([i])
+        timeouts = self._timeouts(i)
+        futures = []
+        for code, count in uniques.values():
+            _data = self.data[i].copy()
             _data['focal_fn_full'] = code
-            args.append(_data)
-        results = mp.Pool(50).map(self._run_adapter_mp, args)
-        compiles = sum([r[0] for r in results])
-        passes = sum([r[1] for r in results])
-        
+            futures.append((self.pool.submit(_run_adapter_mp, self._job(_data, timeouts)), count))
+        return futures
+
+    def _record(self, i: int, results: list[tuple[tuple[dict, float], int]]) -> tuple[int, int]:
+        compiles = sum([r[0]['compiled'] * count for r, count in results])
+        passes = sum([r[0]['passed'] * count for r, count in results])
+        outcomes = [{**r[0], 'count': count} for r, count in results]
+        with self._lock:
+            self.counts[i] = (compiles, passes)
+            self.outcomes[i] = outcomes
+            if self.checkpoint is not None:
+                append_jsonl(self.checkpoint, {'idx': i, 'codes': self._codes_hash(self.fn_codes[i]), 
+                                               'compiles': compiles, 'passes': passes, 'outcomes': outcomes})
+            if self.history is not None:
+                self._durations[str(i)] = max([r[1] for r, _ in results])
+                with open(self.history, 'w') as f:
+                    json.dump(self._durations, f)
+        print(f'Case {i}: {passes}/{self.n} passed, {compiles}/{self.n} compiled.')
+        for _k in self.k:
+            print(f'Pass@{_k}: {pass_at_k(self.n, passes, _k)}, Compile@{_k}: {pass_at_k(self.n, compiles, _k)}')
         return compiles, passes
 
+    def evaluate_task(self, i: int) -> tuple[int, int]:
+        '''
+        Tests the generated code of task `i` and records its compile/pass counts.
+        Safe to call from several threads for different tasks.
+        '''
+        if not self._restore(i):
+            self._record(i, [(future.result(), count) for future, count in self._submit(i)])
+        return self.counts[i]
+
+    def _evaluate_all(self):
+        '''
+        Submits every candidate of every pending task as independent jobs, slowest
+        tasks (by historical duration, unknown first) first, and aggregates the
+        counts of each task as its jobs complete.
+        '''
+        pending = [i for i in range(self.case_cnt) if not self._restore(i)]
+        pending.sort(key=lambda i: self._durations.get(str(i), float('inf')), reverse=True)
+        self._calibrate(pending)
+        owners = {}
+        for i in pending:
+            for future, count in self._submit(i):
+                owners[future] = (i, count)
+        results = {i: [] for i in pending}
+        for future in as_completed(owners):
+            i, count = owners[future]
+            results[i].append((future.result(), count))
+            if sum([c for _, c in results[i]]) == self.n:
+                self._record(i, results[i])
+
+    @property
+    def statuses(self) -> dict[str, int]:
+        '''
+        Returns the number of candidates per outcome status, e.g. to tell timeouts
+        apart from compile errors.
+        '''
+        statuses = {}
+        for outcomes in self.outcomes.values():
+            for outcome in outcomes:
+                statuses[outcome['status']] = statuses.get(outcome['status'], 0) + outcome['count']
+        return statuses
+
     @property
     @lru_cache(maxsize=None)
     def score(self) -> tuple[float, float]:
         '''
         Returns the estimated pass@k, compile@k for the benchmark.
         '''
+        self._evaluate_all()
+        if self.builds + self.saved_builds > 0:
+            print(f'Deduplication saved {self.saved_builds}/{self.builds + self.saved_builds} builds.')
+        print('Outcomes: ' + ', '.join([f'{status}={count}' for status, count in self.statuses.items()]))
         pass_k = []
         compile_k = []
         for i in range(self.case_cnt):
-            print(f'Testing case {i}')
-            fn_codes = self.fn_codes[i]
-            assert len(fn_codes) == self.n
-            cc, pc = self._compile_pass_cnt(self.data[i], fn_codes)
-            print(f'{pc}/{self.n} passed, {cc}/{self.n} compiled.')
+            cc, pc = self.counts[i]
             pass_k.append([pass_at_k(self.n, pc, _k) for _k in self.k])
             compile_k.append([pass_at_k(self.n, cc, _k) for _k in self.k])
-            for idx, _k in enumerate(self.k):
-                print(f'Pass@{_k}: {pass_k[-1][idx]}, Compile@{_k}: {compile_k[-1][idx]}')
         return np.mean(pass_k, axis=0), np.mean(compile_k, axis=0)
     
     def __str__(self) -> str:
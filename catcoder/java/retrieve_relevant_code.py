@@ -1,10 +1,11 @@
+import json
 import os
 
 os.environ['PYTHONWARNINGS'] = 'ignore'
 
-import shutil
-import time
+import subprocess
 import torch
+import threading
 import warnings
 
 import chromadb
@@ -26,26 +27,34 @@ from langchain_community.retrievers import BM25Retriever
 from langchain.text_splitter import RecursiveCharacterTextSplitter, Language
 from langchain.retrievers.ensemble import EnsembleRetriever
 
-from test_adapter import Defects4J, rmtree_error_handler
+from bm25 import CodeTokenizer, NumpyBM25Retriever, default_preprocessing_func
+from vector_index import FlatVectorRetriever
+
+from test_adapter import get_checkout_cache
 from util import PROJ2PACKAGE
 
 warnings.filterwarnings("ignore")
 
 T = TypeVar('T')
 
+# Tokens too common in Java code to be useful for lexical retrieval.
+JAVA_KEYWORDS = [
+    'abstract', 'assert', 'boolean', 'break', 'byte', 'case', 'catch', 'char', 'class', 'const', 
+    'continue', 'default', 'do', 'double', 'else', 'enum', 'extends', 'false', 'final', 'finally', 
+    'float', 'for', 'goto', 'if', 'implements', 'import', 'instanceof', 'int', 'interface', 'long', 
+    'native', 'new', 'null', 'package', 'private', 'protected', 'public', 'return', 'short', 'static', 
+    'strictfp', 'super', 'switch', 'synchronized', 'this', 'throw', 'throws', 'transient', 'true', 
+    'try', 'void', 'volatile', 'while',
+]
+
 class JavaLoader(BaseLoader):
-    def __init__(self, path: str, data) -> None:
+    def __init__(self, path: str) -> None:
         self.path = path
-        self.data = data
         assert path.endswith('.java'), f'{path} is not a Java file'
     
     def load(self) -> List[Document]:
         with open(self.path, 'r', encoding='utf-8', errors='ignore') as f:
-            lines = f.readlines()
-        if self.path.endswith(self.data['path']):
-            start, end = self.data['lines'][0], self.data['lines'][3]
-            lines = lines[:start] + lines[end+1:]
-        content = ''.join(lines)
+            content = f.read()
         return [Document(page_content=content, metadata={'source': self.path})]
 
 @lru_cache
@@ -98,7 +107,8 @@ def get_embedding_model(model_path, embedding_cache_dir, namespace, multi_proces
     return embedding_model
 
 class JavaProjectIndexer:
-    def __init__(self, path: str, data, *,
+    def __init__(self, path: str, *,
+                 revision: str=None,
                  chunk_size=2000,
                  chunk_overlap=0,
                  persist_directory='./.rag_cache',
@@ -106,98 +116,222 @@ class JavaProjectIndexer:
                  embedding_model_path=None,
                  embedding_cache_dir='./.embedding_cache',
                  search_type='similarity',
+                 bm25='numpy',
+                 tokenizer='code',
+                 vector_store='chroma',
                  **kwargs):
+        '''
+        - `bm25`, BM25 engine of the lexical retriever, `numpy` (see `NumpyBM25Retriever`,
+          persisted next to the vector store) or `rank_bm25` (`BM25Retriever`). Both score alike
+          up to rounding, but may order tied chunks differently.
+        - `tokenizer`, BM25 tokenization of chunks and queries, `code` (see `CodeTokenizer`)
+          or `whitespace`.
+        - `vector_store`, `chroma` (`CachedChroma`) or `flat`, exact in-process search over
+          a NumPy matrix persisted next to the vector store (see `FlatVectorRetriever`).
+        '''
         self.path = path
-        self.data = data
+        self.revision = revision or repo_revision(path)
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
         self.embedding_model_path = embedding_model_path
+        # Chunks retrieved by each of the vector and BM25 retrievers.
+        self.k = 4
         assert os.path.isdir(path), f'{path} is not a directory'
         if embedding_model is not None:
             self.embedding_model = embedding_model
         else:
             self.embedding_model = get_embedding_model(embedding_model_path, embedding_cache_dir, self.namespace)
         self.loader = DirectoryLoader(self.path, glob='**/*.java', loader_cls=JavaLoader, 
-                                      loader_kwargs={'data': data}, recursive=True, 
+                                      recursive=True, 
                                       use_multithreading=True, max_concurrency=32)
-        self.splitter = RecursiveCharacterTextSplitter.from_language(Language.JAVA, chunk_size=chunk_size, chunk_overlap=chunk_overlap)
-        self.docs = self.loader.load_and_split(self.splitter)
-        vector_indices = CachedChroma.from_documents_with_cache(
-            persist_directory, self.docs, self.embedding_model, collection_name=self.collection_name, **kwargs
-        ).as_retriever(search_type=search_type, search_kwargs={'k': 4})
-        bm25_indices = BM25Retriever.from_documents(self.docs)
-        bm25_indices.k = 4
-        self.indices = EnsembleRetriever(retrievers=[vector_indices, bm25_indices], weights=[0.7, 0.3])
+        self.splitter = RecursiveCharacterTextSplitter.from_language(Language.JAVA, chunk_size=chunk_size, chunk_overlap=chunk_overlap, 
+                                                                     add_start_index=True)
+        self.docs = self._split(self.loader.load())
+        if vector_store == 'flat':
+            self.vector_indices = FlatVectorRetriever.from_documents(
+                self.docs, self.embedding_model, 
+                persist_directory=os.path.join(persist_directory, 'flat', self.collection_name), k=self.k
+            )
+        else:
+            self.vector_indices = CachedChroma.from_documents_with_cache(
+                persist_directory, self.docs, self.embedding_model, collection_name=self.collection_name, **kwargs
+            ).as_retriever(search_type=search_type, search_kwargs={'k': self.k})
+        if tokenizer == 'code':
+            preprocess_func = CodeTokenizer(JAVA_KEYWORDS)
+        else:
+            preprocess_func = default_preprocessing_func
+        if bm25 == 'numpy':
+            self.bm25_indices = NumpyBM25Retriever.from_documents(
+                self.docs, persist_directory=os.path.join(persist_directory, f'bm25-{tokenizer}', self.collection_name), 
+                preprocess_func=preprocess_func, k=self.k
+            )
+        else:
+            self.bm25_indices = BM25Retriever.from_documents(self.docs, preprocess_func=preprocess_func)
+            self.bm25_indices.k = self.k
+        self.indices = EnsembleRetriever(retrievers=[self.vector_indices, self.bm25_indices], weights=[0.7, 0.3])
     
+    def _split(self, docs: List[Document]) -> List[Document]:
+        '''
+        Splits the files into chunks, recording the 1-based line span of each chunk
+        in its `start_line`/`end_line` metadata.
+        '''
+        docs = sorted(docs, key=lambda doc: doc.metadata['source'])
+        contents = {doc.metadata['source']: doc.page_content for doc in docs}
+        chunks = self.splitter.split_documents(docs)
+        for chunk in chunks:
+            content = contents[chunk.metadata['source']]
+            start = chunk.metadata.pop('start_index', -1)
+            if start < 0:
+                # Unknown position, span the whole file so that masking stays conservative.
+                chunk.metadata['start_line'], chunk.metadata['end_line'] = 1, content.count('\n') + 1
+                continue
+            chunk.metadata['start_line'] = content.count('\n', 0, start) + 1
+            chunk.metadata['end_line'] = chunk.metadata['start_line'] + chunk.page_content.count('\n')
+        return chunks
+
     @property
     def namespace(self):
         return sha1(self.embedding_model_path.encode()).hexdigest()
     
     @property
     def collection_name(self):
-        return sha1(self.data['package'].encode()).hexdigest()
+        # `line-spans` marks collections whose chunks carry their line spans.
+        key = [os.path.abspath(self.path), self.revision, self.chunk_size, self.chunk_overlap, 
+               self.embedding_model_path, 'line-spans']
+        return sha1(json.dumps(key).encode()).hexdigest()
     
     @overload
     def search(self, query, *, 
+               exclude: tuple[str, int, int]=None,
                filter_fn: Callable[[Document], bool]=None, 
                map_fn: None=None) -> List[Document]:
         ...
 
     @overload
     def search(self, query, *,
+               exclude: tuple[str, int, int]=None,
                filter_fn: Callable[[Document], bool]=None, 
                map_fn: Callable[[Document], T]=None) -> List[T]:
         ...
     
-    def search(self, query, *, filter_fn=None, map_fn=None):
-        results = self.indices.invoke(query)
-        if filter_fn is not None:
-            results = list(filter(filter_fn, results))
-        if map_fn is not None:
-            results = list(map(map_fn, results))
-        return results
+    def search(self, query, *, exclude=None, filter_fn=None, map_fn=None):
+        '''
+        - `exclude`, `(file, start_line, end_line)` of code that must not be retrieved,
+          e.g. the ground truth (see `ground_truth_span`). Chunks of `file` (relative to
+          the repository) overlapping the 1-based, inclusive line span are masked out
+          before ranking, so that each retriever still contributes `k` chunks.
+        '''
+        return self.search_batch([query], excludes=[exclude], filter_fns=[filter_fn], map_fns=[map_fn])[0]
 
-def run_rag(data_in):
-    data, idx, embedding_model_path = data_in
-    assert data['task_id'] == f'JavaEval/{idx}', (data['task_id'], f'JavaEval/{idx}')
-    
-    tmp = f'/tmp/d4j4rag-{data["original_task_id"]}-{int(time.time())}'
-    os.makedirs(tmp)
+    def search_batch(self, queries: List[str], *, 
+                     excludes: List[tuple[str, int, int]]=None,
+                     filter_fns: List[Callable[[Document], bool]]=None,
+                     map_fns: List[Callable[[Document], Any]]=None) -> List[list]:
+        '''
+        Searches several queries at once, e.g. of all tasks on the repository, with the
+        results of `search` for each of them. With the `flat` vector store, the vector
+        search of all queries is a single matrix product.
+        - `excludes`, `filter_fns`, `map_fns`, the `exclude`, `filter_fn` and `map_fn` of
+          each query (or `None`), see `search`.
+        '''
+        excludes = excludes or [None] * len(queries)
+        filter_fns = filter_fns or [None] * len(queries)
+        map_fns = map_fns or [None] * len(queries)
+        # Retrievers over-fetch by the number of masked chunks, so that `k` remain after masking.
+        masked = max((sum(overlaps(doc, *exclude) for doc in self.docs) 
+                      for exclude in excludes if exclude is not None), default=0)
+        results = []
+        for exclude, *members in zip(excludes, *self._retrieve(queries, self.k + masked)):
+            if exclude is not None:
+                members = [[doc for doc in docs if not overlaps(doc, *exclude)] for docs in members]
+            results.append(self.indices.weighted_reciprocal_rank([docs[:self.k] for docs in members]))
+        for i, (filter_fn, map_fn) in enumerate(zip(filter_fns, map_fns)):
+            if filter_fn is not None:
+                results[i] = list(filter(filter_fn, results[i]))
+            if map_fn is not None:
+                results[i] = list(map(map_fn, results[i]))
+        return results
 
-    d4j = Defects4J(data, tmp)
-    path_postfix = PROJ2PACKAGE[data['package']].replace('.', '/')
-    path = f'{tmp}/{data["source_dir"]}/{path_postfix}'
-    d4j.checkout()
+    def _retrieve(self, queries: List[str], k: int) -> tuple[List[List[Document]], List[List[Document]]]:
+        '''
+        Returns the `k` best chunks of each query from the vector and the BM25 retrievers.
+        '''
+        if isinstance(self.vector_indices, FlatVectorRetriever):
+            vector_results = self.vector_indices.search_batch(queries, k)
+        else:
+            store, search_type = self.vector_indices.vectorstore, self.vector_indices.search_type
+            search_kwargs = {**self.vector_indices.search_kwargs, 'k': k}
+            vector_results = [store.search(query, search_type, **search_kwargs) for query in queries]
+        if isinstance(self.bm25_indices, NumpyBM25Retriever):
+            bm25_results = [self.bm25_indices.top_k(query, k) for query in queries]
+        else:
+            bm25 = self.bm25_indices
+            bm25_results = [bm25.vectorizer.get_top_n(bm25.preprocess_func(query), bm25.docs, n=k) for query in queries]
+        return vector_results, bm25_results
 
-    def drop_ground_truth(doc: Document):
-        return data['focal_fn_signature'] not in doc.page_content
+def ground_truth_span(data) -> tuple[str, int, int]:
+    '''
+    Returns the file of the focal function and its 1-based line span (`lines` is 0-based).
+    '''
+    return data['path'], data['lines'][0] + 1, data['lines'][3] + 1
 
-    def to_context(doc: Document):
-        src = os.path.relpath(doc.metadata['source'], path)
-        idx = src.find(path_postfix)
-        if idx != -1:
-            src = src[idx + len(path_postfix):]
-        src = src.removeprefix('/')
-        return f'// {src}\n' + doc.page_content
+def overlaps(doc: Document, file: str, start_line: int, end_line: int) -> bool:
+    source = os.path.normpath(doc.metadata['source'])
+    file = os.path.normpath(file)
+    if source != file and not source.endswith(os.sep + file):
+        return False
+    return doc.metadata['start_line'] <= end_line and start_line <= doc.metadata['end_line']
 
-    indexer = JavaProjectIndexer(path, data, 
-                                embedding_model_path=embedding_model_path,
-                                persist_directory='./.rag_cache')
-    results = indexer.search(data['hint'] + '\n' + data['focal_fn_signature'], filter_fn=drop_ground_truth, map_fn=to_context)
+@lru_cache
+def repo_revision(path) -> str:
+    '''
+    Identifies the state of the sources under `path`: the commit of its git checkout if
+    any, otherwise a fingerprint of the paths, sizes and modification times of its files.
+    '''
+    if os.path.isdir(os.path.join(path, '.git')):
+        try:
+            return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=path, capture_output=True, 
+                                  text=True, check=True).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            pass
+    fingerprint = sha1()
+    for root, dirs, files in os.walk(path):
+        dirs[:] = sorted([d for d in dirs if d not in ('target', '.git')])
+        for name in sorted(files):
+            stat = os.stat(os.path.join(root, name))
+            fingerprint.update(f'{os.path.relpath(os.path.join(root, name), path)}:{stat.st_size}:{stat.st_mtime_ns}\n'.encode())
+    return fingerprint.hexdigest()
 
-    shutil.rmtree(tmp, onerror=rmtree_error_handler)
-    rag = '\n'.join(list(set(results)))
-    return {'task_id': f'JavaEval/{idx}', 'rag_data': rag}
+_INDEXERS: dict[tuple, JavaProjectIndexer] = {}
+_INDEXERS_LOCK = threading.Lock()
 
-def repocoder_rag(data_in):
-    data, idx, embedding_model_path, ref_code = data_in
-    assert data['task_id'] == f'JavaEval/{idx}', (data['task_id'], f'JavaEval/{idx}')
-    
-    tmp = f'/tmp/d4j4rag-{data["original_task_id"]}-{int(time.time())}'
-    os.makedirs(tmp)
+def get_indexer(path: str, embedding_model_path: str, revision: str=None, 
+                chunk_size=2000, chunk_overlap=0, bm25='numpy', tokenizer='code', 
+                vector_store='chroma', **kwargs) -> JavaProjectIndexer:
+    '''
+    Returns the index of the repository at `path`, built once per process for each
+    (path, revision, chunking config) and shared by all tasks on that repository.
+    The index holds the whole repository, tasks mask out their ground truth with the
+    `exclude` argument of `search`.
+    '''
+    revision = revision or repo_revision(path)
+    key = (os.path.abspath(path), revision, chunk_size, chunk_overlap, embedding_model_path, bm25, tokenizer, vector_store)
+    with _INDEXERS_LOCK:
+        if key not in _INDEXERS:
+            _INDEXERS[key] = JavaProjectIndexer(path, revision=revision, 
+                                               chunk_size=chunk_size, chunk_overlap=chunk_overlap, 
+                                               embedding_model_path=embedding_model_path, 
+                                               bm25=bm25, tokenizer=tokenizer, vector_store=vector_store, **kwargs)
+        return _INDEXERS[key]
 
-    d4j = Defects4J(data, tmp)
+def _task_context(data):
+    '''
+    Returns the source directory of task `data` in the fixed version of its project,
+    its revision, and the filter and formatting of its retrieved chunks.
+    '''
+    checkout = get_checkout_cache().pristine(data['package'], data['bug_id'])
     path_postfix = PROJ2PACKAGE[data['package']].replace('.', '/')
-    path = f'{tmp}/{data["source_dir"]}/{path_postfix}'
-    d4j.checkout()
+    path = f'{checkout}/{data["source_dir"]}/{path_postfix}'
 
     def drop_ground_truth(doc: Document):
         return data['focal_fn_signature'] not in doc.page_content
@@ -210,11 +344,59 @@ def repocoder_rag(data_in):
         src = src.removeprefix('/')
         return f'// {src}\n' + doc.page_content
 
-    indexer = JavaProjectIndexer(path, data, 
-                                embedding_model_path=embedding_model_path,
-                                persist_directory='./.rag_cache')
-    results = indexer.search(ref_code, filter_fn=drop_ground_truth, map_fn=to_context)
+    return path, f'{data["package"]}-{data["bug_id"]}f', drop_ground_truth, to_context
+
+def retrieve_contexts(tasks: List[tuple[dict, str]], embedding_model_path) -> List[List[str]]:
+    '''
+    Retrieves the context of each `(data, query)` task from the shared index of its project,
+    searching the queries of tasks on the same project together (see `search_batch`).
+    The index holds the whole project, so the ground truth is masked by its line span
+    (see `ground_truth_span`), and `drop_ground_truth` also drops other chunks that
+    define the focal function.
+    '''
+    contexts = [_task_context(data) for data, _ in tasks]
+    groups: dict[tuple, list[int]] = {}
+    for i, (path, revision, _, _) in enumerate(contexts):
+        groups.setdefault((path, revision), []).append(i)
+    results = [None] * len(tasks)
+    for (path, revision), ids in groups.items():
+        indexer = get_indexer(path, embedding_model_path, revision=revision, persist_directory='./.rag_cache')
+        batch = indexer.search_batch([tasks[i][1] for i in ids], 
+                                     excludes=[ground_truth_span(tasks[i][0]) for i in ids],
+                                     filter_fns=[contexts[i][2] for i in ids], 
+                                     map_fns=[contexts[i][3] for i in ids])
+        for i, docs in zip(ids, batch):
+            results[i] = list(set(docs))
+    return results
+
+def retrieve_context(data, query: str, embedding_model_path) -> List[str]:
+    return retrieve_contexts([(data, query)], embedding_model_path)[0]
+
+def run_rag(data_in):
+    return run_rag_batch([data_in])[0]
+
+def run_rag_batch(data_ins):
+    '''
+    `run_rag` of several tasks, searching the tasks on the same project and bug together.
+    All of `data_ins` must share the embedding model.
+    '''
+    for data, idx, _ in data_ins:
+        assert data['task_id'] == f'JavaEval/{idx}', (data['task_id'], f'JavaEval/{idx}')
+    tasks = [(data, data['hint'] + '\n' + data['focal_fn_signature']) for data, _, _ in data_ins]
+    results = retrieve_contexts(tasks, data_ins[0][2]) if data_ins else []
+    return [{'task_id': f'JavaEval/{idx}', 'rag_data': '\n'.join(rag)} for (_, idx, _), rag in zip(data_ins, results)]
+
+def repocoder_rag(data_in):
+    return repocoder_rag_batch([data_in])[0]
 
-    shutil.rmtree(tmp, onerror=rmtree_error_handler)
-    rag = '\n'.join(list(set(results)))
-    return {'task_id': f'JavaEval/{idx}', 'repocoder_data': rag}
+def repocoder_rag_batch(data_ins):
+    '''
+    `repocoder_rag` of several tasks, searching the tasks on the same project and bug together.
+    All of `data_ins` must share the embedding model.
+    '''
+    for data, idx, _, _ in data_ins:
+        assert data['task_id'] == f'JavaEval/{idx}', (data['task_id'], f'JavaEval/{idx}')
+    tasks = [(data, ref_code) for data, _, _, ref_code in data_ins]
+    results = retrieve_contexts(tasks, data_ins[0][2]) if data_ins else []
+    return [{'task_id': f'JavaEval/{idx}', 'repocoder_data': '\n'.join(rag)} 
+            for (_, idx, _, _), rag in zip(data_ins, results)]
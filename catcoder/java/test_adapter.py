@@ -1,18 +1,92 @@
+import fcntl
 import os
+import queue
 import tempfile
+import threading
+import time
 import shlex
 import shutil
 import subprocess
 
-from multiprocessing import Lock
+from collections import OrderedDict
+from multiprocessing import util
 
-_MK_LOCK = Lock()
-_RM_LOCK = Lock()
+# Default time limits (seconds) of each stage, see `CratePassK` for budgets learned per project.
+# A `None` test limit scales with the number of test methods.
+DEFAULT_TIMEOUTS = {'compile': 30, 'test': None}
+# Number of trailing stderr characters kept in outcome records.
+STDERR_TAIL = 2000
 
 def rmtree_error_handler(func, path, exc_info):
     print(f'Failed to remove {path} due to {exc_info[1]}, ' +
                       'you may need to remove it manually.')
 
+class Reaper:
+    '''
+    Removes directory trees in a background thread of the current process, so that a
+    test worker never waits on an `rmtree`, its own or another worker's. Trees still
+    pending when the process exits are removed before it does.
+    '''
+    def __init__(self):
+        self.pid = os.getpid()
+        self.trees = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        util.Finalize(self, self.close, exitpriority=0)
+
+    def _run(self):
+        while True:
+            path = self.trees.get()
+            if path is None:
+                break
+            if os.path.isdir(path):
+                shutil.rmtree(path, onerror=rmtree_error_handler)
+
+    def reap(self, path):
+        self.trees.put(path)
+
+    def close(self):
+        self.trees.put(None)
+        self.thread.join()
+
+_REAPER = None
+
+def reap(path):
+    '''
+    Schedules the removal of `path` by the reaper of the current process.
+    '''
+    global _REAPER
+    # Threads do not survive a fork, so forked workers start their own reaper.
+    if _REAPER is None or _REAPER.pid != os.getpid():
+        _REAPER = Reaper()
+    _REAPER.reap(path)
+
+def limit_worker(threads: int=None, memory: int=None):
+    '''
+    Caps the resources of the JVMs spawned by the current worker process (Ant, JUnit and
+    the test harness) through `JAVA_TOOL_OPTIONS`. Meant as the initializer of the test worker pool.
+    - `threads`, number of CPUs each JVM sizes its GC and compiler threads for
+      (`-XX:ActiveProcessorCount`, ignored by JVMs older than 8u191).
+    - `memory`, maximum heap of each JVM in MiB (`-Xmx`). An address space limit is not
+      used, since the JVM reserves far more virtual memory than it uses.
+    '''
+    options = [os.environ.get('JAVA_TOOL_OPTIONS', '')]
+    if threads is not None:
+        # Older JVMs refuse to start on unknown options unless told to ignore them.
+        options.append(f'-XX:+IgnoreUnrecognizedVMOptions -XX:ActiveProcessorCount={threads}')
+    if memory is not None:
+        options.append(f'-Xmx{memory}m')
+    os.environ['JAVA_TOOL_OPTIONS'] = ' '.join([o for o in options if o])
+
+def wait_for_load(max_load: float, max_wait=300, interval=1):
+    '''
+    Blocks the current worker until the 1-minute load average drops below `max_load`,
+    for at most `max_wait` seconds, so that jobs are only admitted when there is CPU to spare.
+    '''
+    deadline = time.monotonic() + max_wait
+    while os.getloadavg()[0] >= max_load and time.monotonic() < deadline:
+        time.sleep(interval)
+
 def run_command(cmd, timeout=30, warn_when_timeout=False):
     proc = subprocess.Popen(shlex.split(cmd), stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
     try:
@@ -25,15 +99,327 @@ def run_command(cmd, timeout=30, warn_when_timeout=False):
     else:
         return proc.returncode == 0, out, err
 
+class CheckoutCache:
+    '''
+    Cache of pristine, pre-compiled Defects4J checkouts keyed by (project, bug id).
+    Each checkout is materialized once and handed out as copy-on-write clones
+    (`cp --reflink=auto`, a plain copy where the file system does not support it).
+    Timestamps are preserved, so `defects4j compile` only recompiles edited sources.
+    '''
+    def __init__(self, cache_dir=None, timeout=1800):
+        '''
+        - `timeout`, time limit in seconds of the one-time checkout and pre-compile of a bug.
+        '''
+        self.cache_dir = cache_dir or os.environ.get('D4J_CACHE_DIR', 
+                                                     os.path.join(tempfile.gettempdir(), 'd4j_cache'))
+        self.timeout = timeout
+        self._attempted: set[tuple] = set()
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def pristine(self, proj, bid) -> str:
+        '''
+        Returns the path of the pristine checkout, creating it if needed.
+        Concurrent callers wait for the one creating it. A checkout that fails to
+        pre-compile is not published, it is kept as `<checkout>.uncompiled` (clones of
+        it compile from scratch) and each process retries compiling it once.
+        '''
+        path = os.path.join(self.cache_dir, f'{proj}-{bid}f')
+        uncompiled = path + '.uncompiled'
+        if os.path.isdir(path):
+            return path
+        if (proj, bid) in self._attempted and os.path.isdir(uncompiled):
+            return uncompiled
+        with open(path + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                if os.path.isdir(path):
+                    return path
+                if (proj, bid) in self._attempted and os.path.isdir(uncompiled):
+                    return uncompiled
+                self._attempted.add((proj, bid))
+                building = path + '.tmp'
+                if os.path.isdir(building):
+                    shutil.rmtree(building, onerror=rmtree_error_handler)
+                if os.path.isdir(uncompiled):
+                    cmd = f'cp -a {uncompiled} {building}'
+                else:
+                    cmd = f'defects4j checkout -p {proj} -v {bid}f -w {building}'
+                res, out, err = run_command(cmd, timeout=self.timeout, warn_when_timeout=True)
+                if not res:
+                    print(f'stdout:\n{out}')
+                    print(f'stderr:\n{err}')
+                    raise RuntimeError(f'Failed to checkout {proj}-{bid}f.')
+                if run_command(f'defects4j compile -w {building}', timeout=self.timeout, warn_when_timeout=True)[0]:
+                    os.rename(building, path)
+                    if os.path.isdir(uncompiled):
+                        shutil.rmtree(uncompiled, onerror=rmtree_error_handler)
+                    return path
+                print(f'Failed to pre-compile {proj}-{bid}f, clones will compile from scratch.')
+                if os.path.isdir(uncompiled):
+                    shutil.rmtree(building, onerror=rmtree_error_handler)
+                else:
+                    os.rename(building, uncompiled)
+                return uncompiled
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def clone(self, proj, bid, work_dir):
+        pristine = self.pristine(proj, bid)
+        os.makedirs(work_dir, exist_ok=True)
+        cmd = f'cp -a --reflink=auto {pristine}/. {work_dir}'
+        res, out, err = run_command(cmd, timeout=120)
+        if not res:
+            print(f'stderr:\n{err}')
+            raise RuntimeError(f'Failed to clone {proj}-{bid}f into {work_dir}.')
+
+_CHECKOUT_CACHE = None
+
+def get_checkout_cache() -> CheckoutCache:
+    global _CHECKOUT_CACHE
+    if _CHECKOUT_CACHE is None:
+        _CHECKOUT_CACHE = CheckoutCache()
+    return _CHECKOUT_CACHE
+
+HARNESS_SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'harness', 'TestHarness.java')
+
+class HarnessError(RuntimeError):
+    '''
+    The test harness of a project/bug cannot be used, candidates fall back to `defects4j`.
+    '''
+
+def class_file_level(classes_dir) -> str:
+    '''
+    Returns the Java language level (`1.6`, `1.8`, `11`, ...) the project was compiled
+    for, read from the major version of one of its class files.
+    '''
+    for root, _, files in os.walk(classes_dir):
+        for name in files:
+            if name.endswith('.class'):
+                with open(os.path.join(root, name), 'rb') as f:
+                    header = f.read(8)
+                major = int.from_bytes(header[6:8], 'big')
+                return f'1.{major - 44}' if major <= 52 else str(major - 44)
+    raise HarnessError(f'No class files in {classes_dir}')
+
+class JvmHarness:
+    '''
+    Long-running JVM (see `harness/TestHarness.java`) for one project/bug. It keeps the
+    test classpath loaded, compiles the focal class of a candidate in memory with
+    `javax.tools` and runs the target JUnit methods against a private clone of the
+    pristine pre-compiled checkout, so that candidates do not pay JVM/Ant startup. The
+    JVM runs in the clone, like `defects4j test`, so tests find their fixtures by
+    relative path, and whatever they write does not leak into the checkout cache.
+    '''
+    def __init__(self, proj, bid):
+        self.proj = proj
+        self.bid = bid
+        self.proc = None
+        self.lines = None
+        self.work_dir = tempfile.mkdtemp(prefix='harness_')
+        try:
+            get_checkout_cache().clone(proj, bid, self.work_dir)
+            classes = os.path.join(self.work_dir, self._export('dir.bin.classes'))
+            tests = os.path.join(self.work_dir, self._export('dir.bin.tests'))
+            libs = [p for p in self._export('cp.test').split(':') 
+                    if p and os.path.abspath(p) not in (os.path.abspath(classes), os.path.abspath(tests))]
+            level = class_file_level(classes)
+            harness_dir = self._build_harness(libs, level)
+        except BaseException:
+            self.close()
+            raise
+        self.cmd = ['java', '-cp', ':'.join([harness_dir] + libs), 'TestHarness', 
+                    classes, tests, ':'.join([classes] + libs), level]
+
+    def _export(self, prop):
+        res, out, err = run_command(f'defects4j export -p {prop} -w {self.work_dir}', timeout=120)
+        if not res:
+            raise HarnessError(f'Failed to export {prop} of {self.proj}-{self.bid}f: {err}')
+        return out.strip()
+
+    def _build_harness(self, libs, level):
+        '''
+        Compiles the harness once per bug for the language level of the project
+        (at least 1.7, which the harness needs). Concurrent workers wait for the one
+        building it, and a partial build is never visible.
+        '''
+        harness_dir = os.path.join(get_checkout_cache().cache_dir, f'{self.proj}-{self.bid}f.harness')
+        if os.path.exists(os.path.join(harness_dir, 'TestHarness.class')):
+            return harness_dir
+        if level.startswith('1.') and int(level[2:]) < 7:
+            level = '1.7'
+        with open(harness_dir + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                if not os.path.exists(os.path.join(harness_dir, 'TestHarness.class')):
+                    building = tempfile.mkdtemp(prefix='harness_', dir=os.path.dirname(harness_dir))
+                    cmd = f'javac -nowarn -source {level} -target {level} -cp {":".join(libs)} -d {building} {HARNESS_SRC}'
+                    res, _, err = run_command(cmd, timeout=120)
+                    if not res:
+                        shutil.rmtree(building, ignore_errors=True)
+                        raise HarnessError(f'Failed to build the test harness: {err}')
+                    if os.path.isdir(harness_dir):
+                        shutil.rmtree(harness_dir, onerror=rmtree_error_handler)
+                    os.rename(building, harness_dir)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+        return harness_dir
+
+    def _start(self):
+        try:
+            self.proc = subprocess.Popen(self.cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, 
+                                         stderr=subprocess.DEVNULL, cwd=self.work_dir, text=True, bufsize=1)
+        except OSError as e:
+            raise HarnessError(f'Failed to start the test harness of {self.proj}-{self.bid}f: {e}')
+        self.lines = queue.Queue()
+
+        def _reader(proc, lines):
+            for line in proc.stdout:
+                lines.put(line.rstrip('\n'))
+            lines.put(None)
+
+        threading.Thread(target=_reader, args=(self.proc, self.lines), daemon=True).start()
+
+    def _stop(self):
+        if self.proc is not None:
+            self.proc.kill()
+            self.proc.wait()
+            self.proc = None
+
+    def close(self):
+        '''
+        Stops the JVM and removes the clone. Safe to call more than once.
+        '''
+        self._stop()
+        if self.work_dir is not None:
+            reap(self.work_dir)
+            self.work_dir = None
+
+    def _send(self, request):
+        '''
+        Sends a request, restarting the JVM once if it has died in between.
+        '''
+        for attempt in range(2):
+            if self.proc is None or self.proc.poll() is not None:
+                self._stop()
+                self._start()
+            try:
+                self.proc.stdin.write(request + '\n')
+                self.proc.stdin.flush()
+                return
+            except (BrokenPipeError, OSError):
+                self._stop()
+        raise HarnessError(f'Test harness of {self.proj}-{self.bid}f keeps dying')
+
+    def run(self, source_file, out_dir, tests: list[str], timeout=60):
+        '''
+        Compiles `source_file` into `out_dir` and runs `tests` on it. Returns whether it
+        compiled, the outcome of each test and whether it timed out. The JVM is restarted
+        if it dies or hangs, in which case the tests without an outcome are reported as failed.
+        '''
+        compiled, outcomes, timed_out = False, {}, False
+        self._send('\t'.join(['TEST', source_file, out_dir, ','.join(tests)]))
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                line = self.lines.get(timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                print(f'Test harness of {self.proj}-{self.bid}f timed out.')
+                line = None
+                timed_out = True
+            if line is None:
+                self._stop()
+                break
+            if line == 'END':
+                break
+            status, _, name = line.partition('\t')
+            if status == 'COMPILED':
+                compiled = True
+            elif status in ('PASS', 'FAIL'):
+                outcomes[name] = status == 'PASS'
+        for t in tests:
+            outcomes.setdefault(t, False)
+        return compiled, outcomes, timed_out
+
+    def verify(self, path, tests: list[str]):
+        '''
+        Checks the harness against the fixed version of the bug, whose relevant tests
+        all pass under `defects4j test`, by running them on its unmodified focal file `path`.
+        '''
+        out_dir = tempfile.mkdtemp(prefix='rtadp_')
+        try:
+            compiled, outcomes, _ = self.run(os.path.join(self.work_dir, path), out_dir, tests, 
+                                             timeout=max(120, 20 * len(tests)))
+        finally:
+            reap(out_dir)
+        failing = [t for t, passed in outcomes.items() if not passed]
+        if not compiled or failing:
+            raise HarnessError(f'Test harness of {self.proj}-{self.bid}f disagrees with defects4j '
+                               f'on the fixed version (compiled={compiled}, failing={failing})')
+
+# Harnesses kept alive per worker process, the least recently used ones beyond it are closed.
+MAX_HARNESSES = 2
+
+_HARNESSES: OrderedDict[tuple[str, int], JvmHarness | None] = OrderedDict()
+
+def get_harness(proj, bid, path, tests: list[str]) -> JvmHarness:
+    '''
+    Returns the harness of the project/bug owned by the current process, which is
+    shut down when the process exits or when `MAX_HARNESSES` more recently used ones
+    are alive. A harness is only used once it passes `verify` with the focal file
+    `path` and `tests` of the first task asking for it, otherwise `HarnessError` is
+    raised for every task of the project/bug.
+    '''
+    if (proj, bid) in _HARNESSES:
+        _HARNESSES.move_to_end((proj, bid))
+    else:
+        harness = None
+        try:
+            harness = JvmHarness(proj, bid)
+            util.Finalize(harness, harness.close, exitpriority=0)
+            harness.verify(path, tests)
+        except HarnessError as e:
+            print(e)
+            if harness is not None:
+                harness.close()
+            harness = None
+        _HARNESSES[(proj, bid)] = harness
+        alive = [key for key, h in _HARNESSES.items() if h is not None]
+        for key in alive[:-MAX_HARNESSES]:
+            _HARNESSES.pop(key).close()
+    if _HARNESSES[(proj, bid)] is None:
+        raise HarnessError(f'No usable test harness for {proj}-{bid}f')
+    return _HARNESSES[(proj, bid)]
+
 class Defects4J:
-    def __init__(self, data, work_dir):
+    def __init__(self, data, work_dir, timeouts: dict=None, batch_methods=False):
         self.proj = data['package']
         self.bid = data['bug_id']
         self.testmethods = data['testmethods']
         self.data = data
         self.work_dir = work_dir
+        self.batch_methods = batch_methods
+        self.timeouts = {**DEFAULT_TIMEOUTS, **(timeouts or {})}
+        self.timed_out = None
+        self.durations = {}
+        self.stderr = ''
+
+    def _run(self, cmd, stage, timeout):
+        '''
+        Runs a `defects4j` command and records its duration under `stage`.
+        '''
+        start = time.perf_counter()
+        res, out, err = run_command(cmd, timeout=timeout, warn_when_timeout=True)
+        self.durations[stage] = self.durations.get(stage, 0) + time.perf_counter() - start
+        if out is None:
+            self.timed_out = stage
+        else:
+            self.stderr = err[-STDERR_TAIL:]
+        return res, out, err
 
-    def checkout(self):
+    def checkout(self, use_cache=True):
+        if use_cache:
+            get_checkout_cache().clone(self.proj, self.bid, self.work_dir)
+            return
         cmd = f'defects4j checkout -p {self.proj} -v {self.bid}f -w {self.work_dir}'
         res, out, err = run_command(cmd)
         if not res:
@@ -53,7 +439,7 @@ class Defects4J:
 
     def compile(self):
         cmd = f'defects4j compile -w {self.work_dir}'
-        return run_command(cmd, warn_when_timeout=True)[0]
+        return self._run(cmd, 'compile', self.timeouts['compile'])[0]
     
     def get_test_result(self, result):
         if not result[0]:
@@ -62,48 +448,170 @@ class Defects4J:
         lines = stdout.split('\n')
         return len(lines) > 0 and lines[-1].startswith('Failing tests: 0')
 
+    def parse_failing_tests(self, stdout):
+        '''
+        Returns the failing tests listed by `defects4j test`, or `None` if no tests ran.
+        '''
+        lines = stdout.strip().split('\n')
+        for idx, line in enumerate(lines):
+            if line.startswith('Failing tests:'):
+                return {l.strip().removeprefix('-').strip() for l in lines[idx+1:] if l.strip().startswith('-')}
+        return None
+
+    def test_methods(self):
+        '''
+        Runs the relevant test methods, one `defects4j test -t` invocation per method, and
+        returns whether each method passed. Returns `None` if no tests could run, e.g. on
+        compile errors. A `test` time limit is shared by all invocations.
+        With `batch_methods`, the methods of a class run in one invocation as
+        `-t Class::m1,m2`. Defects4J does not document this form, it relies on its
+        `-t` pattern accepting commas and on Ant's junit task taking a method list.
+        '''
+        if not self.testmethods:
+            return {}
+        groups = {}
+        for t in self.testmethods:
+            cls, _, method = t.partition('::')
+            groups.setdefault(cls, []).append(method)
+        outcomes = {}
+        ran = False
+        deadline = None if self.timeouts['test'] is None else time.monotonic() + self.timeouts['test']
+        for cls, methods in groups.items():
+            if self.batch_methods and all(methods):
+                targets = [(f'{cls}::{",".join(methods)}', [f'{cls}::{m}' for m in methods])]
+            else:
+                targets = [(t, [t]) for t in self.testmethods if t.partition('::')[0] == cls]
+            for target, names in targets:
+                cmd = f'defects4j test -t {target} -w {self.work_dir}'
+                if deadline is None:
+                    timeout = max(60, 20 * len(names))
+                else:
+                    timeout = max(deadline - time.monotonic(), 1)
+                res, out, _ = self._run(cmd, 'test', timeout)
+                failing = self.parse_failing_tests(out) if out is not None else None
+                ran = ran or failing is not None
+                for name in names:
+                    outcomes[name] = res and failing is not None and \
+                        not any(f == name or f.startswith(name + '::') for f in failing)
+        return outcomes if ran else None
+
     def test(self):
-        for t in self.data['testmethods']:
-            cmd = f'defects4j test -t {t} -w {self.work_dir}'
-            if not self.get_test_result(run_command(cmd, timeout=60, warn_when_timeout=True)):
-                return False
-        return True
+        outcomes = self.test_methods()
+        return outcomes is not None and all(outcomes.values())
     
     def test_all(self):
         cmd = f'defects4j test -w {self.work_dir}'
         return self.get_test_result(run_command(cmd, timeout=120, warn_when_timeout=True))
 
 class TestAdapter:
-    def __init__(self, data):
-        _MK_LOCK.acquire()
+    def __init__(self, data, runner='defects4j', timeouts: dict=None):
+        '''
+        - `runner`, `defects4j` checks out the project and runs the `defects4j` CLI.
+          `defects4j-batch` does too, but runs the test methods of a class in a single
+          call, see `Defects4J.test_methods`. `harness` only writes the edited focal
+          file and submits it to the long-running JVM harness of the project/bug,
+          see `JvmHarness`, falling back to `defects4j` if the harness is unusable.
+        - `timeouts`, time limits of the `compile` and `test` stages, see `DEFAULT_TIMEOUTS`.
+        '''
         self.top_tmp = tempfile.mkdtemp(prefix='rtadp_')
-        _MK_LOCK.release()
         self.compile_success = False
         self.test_success = False
-        self.d4j = Defects4J(data, self.top_tmp)
+        self.outcomes = None
+        self.runner = runner
+        self.d4j = Defects4J(data, self.top_tmp, timeouts, batch_methods=runner == 'defects4j-batch')
+        if runner == 'harness':
+            pristine = get_checkout_cache().pristine(self.d4j.proj, self.d4j.bid)
+            os.makedirs(os.path.dirname(os.path.join(self.top_tmp, data['path'])), exist_ok=True)
+            shutil.copy2(os.path.join(pristine, data['path']), os.path.join(self.top_tmp, data['path']))
+        else:
+            self.d4j.checkout()
+        self.d4j.replace_code()
+
+    def _use_defects4j(self):
+        '''
+        Falls back to the `defects4j` runner when the harness of the project/bug is unusable.
+        '''
+        self.runner = 'defects4j'
         self.d4j.checkout()
         self.d4j.replace_code()
 
+    def _run_harness(self, tests, stage):
+        harness = get_harness(self.d4j.proj, self.d4j.bid, self.d4j.data['path'], self.d4j.testmethods)
+        timeout = self.d4j.timeouts[stage]
+        if timeout is None:
+            timeout = max(60, 20 * len(tests))
+        start = time.perf_counter()
+        compiled, outcomes, timed_out = harness.run(os.path.join(self.top_tmp, self.d4j.data['path']), 
+                                                    os.path.join(self.top_tmp, 'classes'), tests, 
+                                                    timeout=timeout)
+        self.d4j.durations[stage] = self.d4j.durations.get(stage, 0) + time.perf_counter() - start
+        if timed_out:
+            self.d4j.timed_out = stage
+        return compiled, outcomes
+
+    @property
+    def outcome(self) -> dict:
+        '''
+        Structured record of what happened to this candidate. `status` is one of
+        `timeout`, `compile-error`, `compiled` (not tested), `test-fail` and `pass`.
+        '''
+        if self.d4j.timed_out is not None:
+            status = 'timeout'
+        elif not self.compile_success:
+            status = 'compile-error'
+        elif self.test_success:
+            status = 'pass'
+        elif self.outcomes is not None:
+            status = 'test-fail'
+        else:
+            status = 'compiled'
+        return {
+            'status': status,
+            'compiled': self.compile_success,
+            'passed': self.test_success,
+            'timed_out': self.d4j.timed_out,
+            'durations': self.d4j.durations,
+            'stderr': self.d4j.stderr,
+            'tests': self.outcomes,
+        }
+
     def __enter__(self) -> 'TestAdapter':
         return self
     
     def __exit__(self, exc_type, exc_value, traceback):
-        _RM_LOCK.acquire()
-        try:
-            if os.path.isdir(self.top_tmp):
-                shutil.rmtree(self.top_tmp, onerror=rmtree_error_handler)
-        finally:
-            _RM_LOCK.release()
+        reap(self.top_tmp)
         return False
     
     def compile(self) -> bool:
+        if self.runner == 'harness':
+            try:
+                self.compile_success = self._run_harness([], 'compile')[0]
+                return self.compile_success
+            except HarnessError:
+                self._use_defects4j()
         self.compile_success = self.d4j.compile()
         return self.compile_success
     
     def test(self) -> bool:
-        if not self.compile_success:
+        '''
+        `defects4j test` compiles the project itself, so a separate compilation is
+        only run to tell compile errors apart when no tests could run, or when the task
+        has no test methods.
+        '''
+        if self.runner == 'harness':
+            try:
+                self.compile_success, self.outcomes = self._run_harness(self.d4j.testmethods, 'test')
+                self.test_success = self.compile_success and all(self.outcomes.values())
+                return self.test_success
+            except HarnessError:
+                self._use_defects4j()
+        self.outcomes = self.d4j.test_methods()
+        if not self.d4j.testmethods:
+            self.test_success = self.compile()
+        elif self.outcomes is None:
             self.compile()
-        if not self.compile_success:
-            return False
-        self.test_success = self.d4j.test()
+            self.test_success = False
+        else:
+            self.compile_success = True
+            self.test_success = all(self.outcomes.values())
         return self.test_success
@@ -1,3 +1,4 @@
+import json
 import os
 import re
 
@@ -89,3 +90,36 @@ def remove_markdown(rust_code: str, **_):
     lines = rust_code.strip().split('\n')
     lines = list(filter(lambda x: not x.startswith('```'), lines))
     return '\n'.join(lines)
+
+def normalize_code(code: str) -> str:
+    '''
+    Normalizes whitespace that cannot change the behaviour of the code, so that
+    candidates differing only in trailing spaces or surrounding blank lines compare equal.
+    '''
+    return '\n'.join([line.rstrip() for line in code.strip().split('\n')])
+
+def load_jsonl(path: str) -> list[dict]:
+    '''
+    Loads records from a JSONL checkpoint, skipping a truncated last line left by a crash.
+    '''
+    if not os.path.exists(path):
+        return []
+    records = []
+    with open(path, 'r') as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                pass
+    return records
+
+def append_jsonl(path: str, record: dict):
+    with open(path, 'ab+') as f:
+        line = (json.dumps(record) + '\n').encode()
+        if f.tell() > 0:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b'\n':
+                # terminate a line truncated by a previous crash
+                line = b'\n' + line
+        f.write(line)
+        f.flush()
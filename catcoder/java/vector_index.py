@@ -0,0 +1,137 @@
+import json
+import os
+import shutil
+import tempfile
+import numpy as np
+
+from hashlib import sha1
+from typing import Any, Iterable, List, Optional
+
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.retrievers import BaseRetriever
+
+class FlatVectorIndex:
+    '''
+    Exact cosine similarity search over the L2-normalized embeddings of a small corpus
+    (one crate or project), kept as a NumPy matrix. Saved indices are memory-mapped
+    when loaded. Queries are scored with one matrix product per block of `block_size`
+    rows, so a batch of queries costs a single pass over the matrix.
+    '''
+    def __init__(self, embeddings: np.ndarray, block_size=16384):
+        self.embeddings = embeddings
+        self.block_size = block_size
+
+    @staticmethod
+    def normalize(vectors) -> np.ndarray:
+        vectors = np.asarray(vectors, dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-12)
+
+    @classmethod
+    def build(cls, vectors, dtype=np.float32, **kwargs) -> 'FlatVectorIndex':
+        return cls(cls.normalize(vectors).astype(dtype), **kwargs)
+
+    def save(self, path: str):
+        np.save(path, self.embeddings)
+
+    @classmethod
+    def load(cls, path: str, **kwargs) -> 'FlatVectorIndex':
+        return cls(np.load(path, mmap_mode='r'), **kwargs)
+
+    def __len__(self) -> int:
+        return len(self.embeddings)
+
+    def search(self, queries, k: int) -> tuple[np.ndarray, np.ndarray]:
+        '''
+        Returns the ids and cosine similarities of the `k` nearest documents of each
+        query, best first, as two `(len(queries), k)` arrays.
+        '''
+        queries = self.normalize(np.atleast_2d(queries))
+        k = min(k, len(self))
+        ids = np.zeros((len(queries), 0), dtype=np.int64)
+        scores = np.zeros((len(queries), 0), dtype=np.float32)
+        for start in range(0, len(self), self.block_size):
+            # float16 matrices are upcast block by block, BLAS has no float16 GEMM.
+            block = np.asarray(self.embeddings[start:start + self.block_size], dtype=np.float32)
+            ids = np.concatenate([ids, np.broadcast_to(np.arange(start, start + len(block)),
+                                                       (len(queries), len(block)))], axis=1)
+            scores = np.concatenate([scores, queries @ block.T], axis=1)
+            if scores.shape[1] > k:
+                top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+                ids = np.take_along_axis(ids, top, axis=1)
+                scores = np.take_along_axis(scores, top, axis=1)
+        order = np.argsort(-scores, axis=1, kind='stable')
+        return np.take_along_axis(ids, order, axis=1), np.take_along_axis(scores, order, axis=1)
+
+class FlatVectorRetriever(BaseRetriever):
+    '''
+    In-process alternative to a Chroma retriever backed by a `FlatVectorIndex`,
+    e.g. as a member of an `EnsembleRetriever`.
+    '''
+    index: Any
+    docs: List[Document]
+    embedding: Embeddings
+    k: int = 4
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    @classmethod
+    def from_documents(cls, documents: Iterable[Document], embedding: Embeddings, *,
+                       persist_directory: Optional[str]=None,
+                       dtype=np.float32,
+                       **kwargs: Any) -> 'FlatVectorRetriever':
+        '''
+        - `persist_directory`, where indices are saved (`.npy` next to the chunks), under
+          a digest of the documents. An index of the same documents is loaded
+          (memory-mapped) instead of being embedded again, so the directory must be
+          specific to `embedding`.
+        - `dtype`, `np.float32` or `np.float16` to halve the memory.
+        '''
+        docs = list(documents)
+        directory = None
+        if persist_directory is not None:
+            digest = sha1(np.dtype(dtype).name.encode())
+            for doc in docs:
+                digest.update(doc.page_content.encode() + b'\0')
+            directory = os.path.join(persist_directory, digest.hexdigest())
+        if directory is not None and os.path.isdir(directory):
+            index = FlatVectorIndex.load(os.path.join(directory, 'embeddings.npy'))
+        else:
+            vectors = embedding.embed_documents([doc.page_content for doc in docs])
+            index = FlatVectorIndex.build(vectors, dtype=dtype)
+            if directory is not None:
+                cls._save(directory, index, docs)
+        return cls(index=index, docs=docs, embedding=embedding, **kwargs)
+
+    @staticmethod
+    def _save(directory: str, index: FlatVectorIndex, docs: List[Document]):
+        '''
+        Saves the index atomically, keeping an index already saved in `directory`.
+        '''
+        parent = os.path.dirname(os.path.abspath(directory))
+        os.makedirs(parent, exist_ok=True)
+        tmp = tempfile.mkdtemp(dir=parent)
+        index.save(os.path.join(tmp, 'embeddings.npy'))
+        with open(os.path.join(tmp, 'chunks.json'), 'w') as f:
+            json.dump([{'page_content': doc.page_content, 'metadata': doc.metadata} for doc in docs], f)
+        try:
+            os.rename(tmp, directory)
+        except OSError:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    def search_batch(self, queries: List[str], k: int=None) -> List[List[Document]]:
+        '''
+        Retrieves the `k` (defaults to `self.k`) documents of several queries with a single
+        pass over the index.
+        '''
+        if not queries:
+            return []
+        ids, _ = self.index.search([self.embedding.embed_query(q) for q in queries], k or self.k)
+        return [[self.docs[i] for i in row] for row in ids]
+
+    def _get_relevant_documents(self, query: str, *,
+                                run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        return self.search_batch([query])[0]
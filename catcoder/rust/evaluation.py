@@ -1,6 +1,8 @@
 import os
 import json
 
+from concurrent.futures import ThreadPoolExecutor
+
 from datasets import load_from_disk
 
 from metrics import CratePassK
@@ -10,6 +12,8 @@ from util import (
     remove_markdown, 
     fix_fragmented_code, 
     truncate_generation,
+    load_jsonl,
+    append_jsonl,
 )
 
 class Benchmark:
@@ -19,16 +23,29 @@ class Benchmark:
     - Generating code from model and postprocessing
     - Evaluating the generated code
     '''
-    def __init__(self, model: Model, name: str, n=10, k=[1,3,5], cache=False):
+    def __init__(self, model: Model, name: str, n=10, k=[1,3,5], cache=False, batch_size=1, resume=False, 
+                 pipeline_workers: int=None, metric_kwargs: dict=None):
         '''
         - `n` and `k`, refer to https://arxiv.org/abs/2107.03374 for details.
         - `cache`, whether to load cached results from disk. 
+        - `batch_size`, number of tasks whose prompts are sent to the model at once.
+          `None` sends the whole dataset in one batch.
+        - `resume`, whether to skip tasks already recorded in the generation and
+          evaluation checkpoints (JSONL files next to the cache file). Checkpoints are not
+          keyed on the prompt or the metric, so only resume an interrupted run of the same setup.
+        - `pipeline_workers`, if set, test each task as soon as its code is generated,
+          with up to this many tasks being tested concurrently.
+        - `metric_kwargs`, extra options of the metric, e.g. `workers` or `check_first`.
         '''
         self.name = name
         self.model = model
         self.n = n
         self.k = k
         self.cache = cache
+        self.batch_size = batch_size
+        self.resume = resume
+        self.pipeline_workers = pipeline_workers
+        self.metric_kwargs = metric_kwargs or {}
         self.data = load_from_disk(f'./dataset/{self.name}')
         self.postprocs = [truncate_generation, remove_markdown, fix_fragmented_code]
         os.makedirs(f'results/{self.name}', exist_ok=True)
@@ -36,6 +53,14 @@ class Benchmark:
     @property
     def cache_file(self):
         return f'results/{self.name}/{self.model.info}_n{self.n}.json'
+
+    @property
+    def codegen_checkpoint_file(self):
+        return f'results/{self.name}/{self.model.info}_n{self.n}.codegen.jsonl'
+
+    @property
+    def eval_checkpoint_file(self):
+        return f'results/{self.name}/{self.model.info}_n{self.n}.eval.jsonl'
     
     def _from_hf_data(self, data):
         raise NotImplementedError()
@@ -47,24 +72,36 @@ class Benchmark:
 
     def _model(self, prompt):
         return self._postprocess_code(self.model.infer(prompt))
+
+    def _model_n(self, prompt, n):
+        return [self._postprocess_code(code) for code in self.model.infer_n(prompt, n)]
+    
+    def _complete_signature(self, data, code):
+        if not code.startswith('fn') and not code.startswith('pub fn'):
+            code = data['signature'] + ' ' + code
+        return code
     
     def _codegen(self, data, *_, **__):
         '''
         Use model to generate code. To support alternative models or pipelines, 
         override this method in subclasses.
         '''
-        codes = []
-        
-        for _ in range(self.n):
-            codegen_prompt = build_prompt(self._from_hf_data(data), True)
-            code = self._model(codegen_prompt)
-            if not code.startswith('fn') and not code.startswith('pub fn'):
-                code = data['signature'] + ' ' + code
-            codes.append(code)
-        
-        return codes
+        codegen_prompt = build_prompt(self._from_hf_data(data), True)
+        return [self._complete_signature(data, code) for code in self._model_n(codegen_prompt, self.n)]
+
+    def _codegen_batch(self, batch):
+        '''
+        Generate code for several tasks at once, results are in the order of `batch`.
+        '''
+        prompts = [build_prompt(self._from_hf_data(data), True) for data in batch]
+        results = self.model.infer_batch(prompts, self.n)
+        return [[self._complete_signature(data, self._postprocess_code(code)) for code in codes]
+                for data, codes in zip(batch, results)]
 
-    def _batched_codegen(self):
+    def _batched_codegen(self, on_task=None):
+        '''
+        - `on_task`, called with `(idx, codes)` once the code of a task is available.
+        '''
         fn_codes = []
 
         if self.cache and os.path.exists(self.cache_file):
@@ -73,20 +110,79 @@ class Benchmark:
                 fn_codes = d['fn_codes']
                 assert d['n'] == self.n
                 assert d['benchmark'] == self.name
+            if on_task is not None:
+                for idx, codes in enumerate(fn_codes):
+                    on_task(idx, codes)
         else:
-            for idx, data in enumerate(self.data):
-                print(f'Processing {idx}...')
-                results = self._codegen(data)
-                assert len(results) == self.n
-                fn_codes.append(results)
+            fn_codes = self._generate(on_task)
         
         return fn_codes
+
+    def _generate(self, on_task=None):
+        '''
+        Generate code for all tasks, appending each task's results to the checkpoint
+        as soon as they are available, so that a restart only generates the rest.
+        '''
+        if not self.resume and os.path.exists(self.codegen_checkpoint_file):
+            os.remove(self.codegen_checkpoint_file)
+        done = {r['idx']: r['fn_codes'] for r in load_jsonl(self.codegen_checkpoint_file)
+                if len(r['fn_codes']) == self.n}
+        todo = [idx for idx in range(len(self.data)) if idx not in done]
+        if len(done) > 0:
+            print(f'Resuming from checkpoint, {len(done)} tasks already generated.')
+        if on_task is not None:
+            for idx in sorted(done):
+                on_task(idx, done[idx])
+
+        if self.batch_size == 1:
+            for idx in todo:
+                print(f'Processing {idx}...')
+                results = self._codegen(self.data[idx])
+                assert len(results) == self.n
+                done[idx] = results
+                append_jsonl(self.codegen_checkpoint_file, {'idx': idx, 'fn_codes': results})
+                if on_task is not None:
+                    on_task(idx, results)
+        else:
+            batch_size = self.batch_size or max(len(todo), 1)
+            for start in range(0, len(todo), batch_size):
+                indices = todo[start:start + batch_size]
+                print(f'Processing {indices[0]}-{indices[-1]}...')
+                results = self._codegen_batch(self.data.select(indices))
+                assert len(results) == len(indices)
+                for idx, result in zip(indices, results):
+                    assert len(result) == self.n
+                    done[idx] = result
+                    append_jsonl(self.codegen_checkpoint_file, {'idx': idx, 'fn_codes': result})
+                    if on_task is not None:
+                        on_task(idx, result)
+
+        return [done[idx] for idx in range(len(self.data))]
     
     def _evaluate(self):
         '''
         Evaluate the generated code using unbiased pass@k metric.
         '''
         raise NotImplementedError()
+
+    def _metric(self, fn_codes):
+        raise NotImplementedError()
+
+    def _pipelined_evaluate(self):
+        '''
+        Test each task on a pool of workers as soon as its code is generated,
+        so that generation and testing overlap.
+        '''
+        metric = self._metric([None] * len(self.data))
+        futures = []
+        with ThreadPoolExecutor(self.pipeline_workers) as executor:
+            def on_task(idx, codes):
+                metric.fn_codes[idx] = codes
+                futures.append(executor.submit(metric.evaluate_task, idx))
+            fn_codes = self._batched_codegen(on_task)
+            for future in futures:
+                future.result()
+        return metric, fn_codes
     
     def _dump_cache(self, metric, fn_codes):
         if self.cache and os.path.exists(self.cache_file):
@@ -99,6 +195,7 @@ class Benchmark:
                 'n': self.n,
                 'k': self.k,
                 'fn_codes': fn_codes,
+                'outcomes': [metric.outcomes.get(i, []) for i in range(len(fn_codes))],
             }
             json.dump(d, f, indent=2)
         print(f'Results dumped to {self.cache_file}.')
@@ -108,20 +205,30 @@ class Benchmark:
 
 
 class RustEval(Benchmark):
-    def __init__(self, model: Model, n=10, cache=False):
-        super().__init__(model, 'rusteval', n=n, cache=cache)
+    def __init__(self, model: Model, n=10, cache=False, **kwargs):
+        super().__init__(model, 'rusteval', n=n, cache=cache, **kwargs)
         self.crates_base = './crates'
+
+    def _metric(self, fn_codes):
+        return CratePassK(self.n, self.k, fn_codes, self.crates_base, self.data, 
+                          checkpoint=self.eval_checkpoint_file, resume=self.resume, 
+                          history=f'results/{self.name}/test_durations.json', 
+                          budgets=f'results/{self.name}/timeout_budgets.json', **self.metric_kwargs)
     
     def _evaluate(self):
         print(f'Running {self.name} benchmark with n={self.n} ...')
-        fn_codes = self._batched_codegen()
-        metric = CratePassK(self.n, self.k, fn_codes, self.crates_base, self.data)
-        print(metric)
+        if self.pipeline_workers:
+            metric, fn_codes = self._pipelined_evaluate()
+        else:
+            fn_codes = self._batched_codegen()
+            metric = self._metric(fn_codes)
+        with metric:
+            print(metric)
         return metric, fn_codes
 
 class RustEvalCatCoder(RustEval):
-    def __init__(self, model: Model, n=10, cache=False):
-        super().__init__(model, n, cache)
+    def __init__(self, model: Model, n=10, cache=False, **kwargs):
+        super().__init__(model, n, cache, **kwargs)
         self.name = 'rusteval_xc'
         os.makedirs(f'results/{self.name}', exist_ok=True)
 
@@ -134,8 +241,8 @@ class RustEvalCatCoder(RustEval):
         }
 
 class RustEvalInFile(RustEval):
-    def __init__(self, model: Model, n=10, cache=False):
-        super().__init__(model, n, cache)
+    def __init__(self, model: Model, n=10, cache=False, **kwargs):
+        super().__init__(model, n, cache, **kwargs)
         self.name = 'rusteval_if'
         os.makedirs(f'results/{self.name}', exist_ok=True)
 
@@ -148,8 +255,8 @@ class RustEvalInFile(RustEval):
         }
 
 class RustEvalRepoCoder(RustEval):
-    def __init__(self, model: Model, n=10, cache=False):
-        super().__init__(model, n, cache)
+    def __init__(self, model: Model, n=10, cache=False, **kwargs):
+        super().__init__(model, n, cache, **kwargs)
         self.name = 'rusteval_repo'
         os.makedirs(f'results/{self.name}', exist_ok=True)
 
@@ -162,8 +269,8 @@ class RustEvalRepoCoder(RustEval):
         }
     
 class RustEvalVanilla(RustEval):
-    def __init__(self, model: Model, n=10, cache=False):
-        super().__init__(model, n, cache)
+    def __init__(self, model: Model, n=10, cache=False, **kwargs):
+        super().__init__(model, n, cache, **kwargs)
         self.name = 'rusteval_basic'
         os.makedirs(f'results/{self.name}', exist_ok=True)
 
@@ -176,8 +283,8 @@ class RustEvalVanilla(RustEval):
         }
     
 class RustEvalWithoutContext(RustEval):
-    def __init__(self, model: Model, n=10, cache=False):
-        super().__init__(model, n, cache)
+    def __init__(self, model: Model, n=10, cache=False, **kwargs):
+        super().__init__(model, n, cache, **kwargs)
         self.name = 'rusteval-tc'
         os.makedirs(f'results/{self.name}', exist_ok=True)
 
@@ -190,8 +297,8 @@ class RustEvalWithoutContext(RustEval):
         }
 
 class RustEvalWithoutRetrieval(RustEval):
-    def __init__(self, model: Model, n=10, cache=False):
-        super().__init__(model, n, cache)
+    def __init__(self, model: Model, n=10, cache=False, **kwargs):
+        super().__init__(model, n, cache, **kwargs)
         self.name = 'rusteval-cr'
         os.makedirs(f'results/{self.name}', exist_ok=True)
 
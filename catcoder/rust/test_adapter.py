@@ -1,40 +1,213 @@
+import errno
+import json
 import os
+import queue
 import tempfile
+import threading
 import shlex
 import shutil
 import subprocess
+import time
 
-from multiprocessing import Lock
+from multiprocessing import util
 
-_MK_LOCK = Lock()
-_RM_LOCK = Lock()
+# Default time limits (seconds) of each stage, see `CratePassK` for budgets learned per crate.
+DEFAULT_TIMEOUTS = {'compile': 30, 'test': 30}
+# Number of trailing stderr characters kept in outcome records.
+STDERR_TAIL = 2000
 
 def rmtree_error_handler(func, path, exc_info):
     print(f'Failed to remove {path} due to {exc_info[1]}, ' +
                       'you may need to remove it manually.')
 
+class Reaper:
+    '''
+    Removes directory trees in a background thread of the current process, so that a
+    test worker never waits on an `rmtree`, its own or another worker's. Trees still
+    pending when the process exits are removed before it does.
+    '''
+    def __init__(self):
+        self.pid = os.getpid()
+        self.trees = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        util.Finalize(self, self.close, exitpriority=0)
+
+    def _run(self):
+        while True:
+            path = self.trees.get()
+            if path is None:
+                break
+            if os.path.isdir(path):
+                shutil.rmtree(path, onerror=rmtree_error_handler)
+
+    def reap(self, path):
+        self.trees.put(path)
+
+    def close(self):
+        self.trees.put(None)
+        self.thread.join()
+
+_REAPER = None
+
+def reap(path):
+    '''
+    Schedules the removal of `path` by the reaper of the current process.
+    '''
+    global _REAPER
+    # Threads do not survive a fork, so forked workers start their own reaper.
+    if _REAPER is None or _REAPER.pid != os.getpid():
+        _REAPER = Reaper()
+    _REAPER.reap(path)
+
+def limit_worker(threads: int=None, memory: int=None):
+    '''
+    Caps the resources of the current worker process and the cargo processes it spawns.
+    Meant as the initializer of the test worker pool.
+    - `threads`, number of parallel rustc jobs of cargo (`CARGO_BUILD_JOBS`).
+    - `memory`, address space limit in MiB (`RLIMIT_AS`), inherited by cargo and rustc.
+    '''
+    if threads is not None:
+        os.environ['CARGO_BUILD_JOBS'] = str(threads)
+    if memory is not None:
+        try:
+            import resource
+            limit = memory * 1024 * 1024
+            resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+        except (ImportError, ValueError, OSError) as e:
+            print(f'Failed to limit the memory of worker {os.getpid()}: {e}')
+
+def wait_for_load(max_load: float, max_wait=300, interval=1):
+    '''
+    Blocks the current worker until the 1-minute load average drops below `max_load`,
+    for at most `max_wait` seconds, so that jobs are only admitted when there is CPU to spare.
+    '''
+    deadline = time.monotonic() + max_wait
+    while os.getloadavg()[0] >= max_load and time.monotonic() < deadline:
+        time.sleep(interval)
+
+# Files cargo may rewrite in place, which must not be shared with the original crate.
+_PRIVATE_FILES = ['Cargo.lock']
+
+def link_tree(src, dst, private: list[str]):
+    '''
+    Mirrors `src` into `dst` with hard links, except for the `target` directory, which
+    is skipped, and the `private` files (relative paths), which are copied. Falls back
+    to copying when hard links are not supported, e.g. across file systems.
+    '''
+    for root, dirs, files in os.walk(src):
+        rel_root = os.path.relpath(root, src)
+        if rel_root == '.':
+            dirs[:] = [d for d in dirs if d != 'target']
+        os.makedirs(os.path.join(dst, rel_root), exist_ok=True)
+        for name in files:
+            rel = os.path.normpath(os.path.join(rel_root, name))
+            src_file, dst_file = os.path.join(src, rel), os.path.join(dst, rel)
+            if rel in private:
+                shutil.copy2(src_file, dst_file)
+                continue
+            try:
+                os.link(src_file, dst_file)
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                    raise
+                shutil.copy2(src_file, dst_file)
+
+def worker_target_dir(crate):
+    '''
+    Returns a `CARGO_TARGET_DIR` private to the current worker process, seeded once from
+    the prebuilt `target` directory of the crate (reflinked where the file system allows)
+    and removed when the worker exits.
+    '''
+    package = os.path.basename(os.path.normpath(crate))
+    target = os.path.join(tempfile.gettempdir(), f'rtadp_target_{package}_{os.getpid()}')
+    if not os.path.isdir(target):
+        prebuilt = os.path.join(crate, 'target')
+        if os.path.isdir(prebuilt):
+            subprocess.run(['cp', '-r', '--reflink=auto', prebuilt, target], 
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        os.makedirs(target, exist_ok=True)
+        util.Finalize(None, shutil.rmtree, args=(target,), kwargs={'ignore_errors': True}, exitpriority=0)
+    return target
+
+def worker_sandbox(crate):
+    '''
+    Returns a long-lived hard-linked mirror of the crate private to the current worker
+    process. Candidates of the same crate reuse it, so that its build state stays warm.
+    '''
+    package = os.path.basename(os.path.normpath(crate))
+    sandbox = os.path.join(tempfile.gettempdir(), f'rtadp_sandbox_{package}_{os.getpid()}')
+    if not os.path.isdir(sandbox):
+        link_tree(crate, sandbox, _PRIVATE_FILES)
+        util.Finalize(None, shutil.rmtree, args=(sandbox,), kwargs={'ignore_errors': True}, exitpriority=0)
+    return sandbox
+
+def unshare_file(path):
+    '''
+    Replaces a hard-linked file with a private copy, so that editing it leaves the original intact.
+    '''
+    if os.stat(path).st_nlink > 1:
+        shutil.copy2(path, path + '.rtadp')
+        os.replace(path + '.rtadp', path)
+
 class TestAdapter:
-    def __init__(self, crate_base, data, replace_test=False):
-        _MK_LOCK.acquire()
-        self.top_tmp = tempfile.mkdtemp(prefix='rtadp_')
-        _MK_LOCK.release()
+    def __init__(self, crate_base, data, replace_test=False, workspace='link', timeouts: dict=None):
+        '''
+        - `workspace`, how the crate is materialized for this candidate. `sandbox` patches
+          the focal file in a warm per-worker mirror of the crate, builds incrementally and
+          restores the file afterwards. `link` hard links the sources into a fresh directory
+          (only the edited file and `Cargo.lock` are private). Both build into a per-worker
+          target directory. `copy` copies the whole crate, including `target`.
+        - `timeouts`, time limits of the `compile` and `test` stages, see `DEFAULT_TIMEOUTS`.
+        '''
         self.data = data
         self.compile_success = False
         self.test_success = False
-        shutil.copytree(os.path.join(crate_base, self.data['package']), self.top_tmp, dirs_exist_ok=True)
-        self._make_project(replace_test)
+        self.env = None
+        self.errors = []
+        self.timeouts = {**DEFAULT_TIMEOUTS, **(timeouts or {})}
+        self.timed_out = None
+        self.durations = {}
+        self.stderr = ''
+        self._pristine = None
+        crate = os.path.join(crate_base, self.data['package'])
+        if workspace == 'sandbox':
+            self.top_tmp = worker_sandbox(crate)
+            file = os.path.join(self.top_tmp, self.data['path'])
+            unshare_file(file)
+            with open(file, 'rb') as f:
+                self._pristine = f.read()
+        else:
+            self.top_tmp = tempfile.mkdtemp(prefix='rtadp_')
+        try:
+            if workspace == 'link':
+                link_tree(crate, self.top_tmp, _PRIVATE_FILES + [os.path.normpath(self.data['path'])])
+            elif workspace == 'copy':
+                shutil.copytree(crate, self.top_tmp, dirs_exist_ok=True)
+            if workspace != 'copy':
+                self.env = dict(os.environ, CARGO_TARGET_DIR=worker_target_dir(crate))
+            self._make_project(replace_test)
+        except BaseException:
+            # `__exit__` does not run when `__init__` raises, and a warm sandbox must not stay patched.
+            self._cleanup()
+            raise
 
     def __enter__(self) -> 'TestAdapter':
         return self
     
     def __exit__(self, exc_type, exc_value, traceback):
-        _RM_LOCK.acquire()
-        try:
-            if os.path.isdir(self.top_tmp):
-                shutil.rmtree(self.top_tmp, onerror=rmtree_error_handler)
-        finally:
-            _RM_LOCK.release()
+        self._cleanup()
         return False
+
+    def _cleanup(self):
+        '''
+        Restores the focal file of a sandbox byte for byte, or removes the temporary crate.
+        '''
+        if self._pristine is not None:
+            with open(os.path.join(self.top_tmp, self.data['path']), 'wb') as f:
+                f.write(self._pristine)
+        else:
+            reap(self.top_tmp)
     
     def _make_project(self, replace_test):
         '''
@@ -56,31 +229,125 @@ class TestAdapter:
         with open(file, 'w') as f2:
             f2.writelines(lines)
     
-    def compile(self) -> bool:
-        proc = subprocess.Popen(shlex.split('cargo build'), 
+    def _cargo(self, cmd, stage, timeout):
+        '''
+        Runs a cargo command in the crate and records its duration under `stage`.
+        Returns `(returncode, stdout, stderr)`, with `returncode` being `None` on timeout.
+        '''
+        start = time.perf_counter()
+        proc = subprocess.Popen(shlex.split(cmd), 
                                 stdout=subprocess.PIPE,
                                 stderr=subprocess.PIPE,
-                                cwd=self.top_tmp)
+                                cwd=self.top_tmp,
+                                env=self.env,
+                                text=True)
         try:
-            proc.wait(timeout=30)
+            out, err = proc.communicate(timeout=timeout)
         except subprocess.TimeoutExpired:
             proc.kill()
+            out, err = proc.communicate()
+            returncode = None
+            self.timed_out = stage
+        else:
+            returncode = proc.returncode
+        self.durations[stage] = self.durations.get(stage, 0) + time.perf_counter() - start
+        self.stderr = err[-STDERR_TAIL:]
+        return returncode, out, err
+
+    @property
+    def outcome(self) -> dict:
+        '''
+        Structured record of what happened to this candidate. `status` is one of
+        `timeout`, `compile-error`, `compiled` (not tested), `test-fail` and `pass`.
+        '''
+        if self.timed_out is not None:
+            status = 'timeout'
+        elif not self.compile_success:
+            status = 'compile-error'
+        elif self.test_success:
+            status = 'pass'
+        elif 'test' in self.durations:
+            status = 'test-fail'
+        else:
+            status = 'compiled'
+        return {
+            'status': status,
+            'compiled': self.compile_success,
+            'passed': self.test_success,
+            'timed_out': self.timed_out,
+            'durations': self.durations,
+            'stderr': self.stderr,
+            'errors': self.errors,
+        }
+    
+    def compile(self, check=False) -> bool:
+        '''
+        - `check`, only type-check the crate with `cargo check`, skipping codegen and linking.
+        '''
+        returncode, _, _ = self._cargo('cargo check' if check else 'cargo build', 
+                                       'compile', self.timeouts['compile'])
+        if returncode is None:
             print('Compile timeout, please increase the time limit.')
         else:
-            self.compile_success = proc.returncode == 0
+            self.compile_success = returncode == 0
         return self.compile_success
     
-    def test(self) -> bool:
-        self.compile()
-        if self.compile_success:
-            proc = subprocess.Popen(shlex.split(f'cargo test --doc {self.data["lines"][0]}'), 
-                                    stdout=subprocess.PIPE,
-                                    stderr=subprocess.PIPE,
-                                    cwd=self.top_tmp)
+    def check(self) -> bool:
+        '''
+        Type-checks the crate with `cargo check --message-format=json`, and collects
+        the compiler errors in `self.errors` as `{code, message, file, line}` records.
+        '''
+        returncode, out, _ = self._cargo('cargo check --message-format=json', 
+                                         'compile', self.timeouts['compile'])
+        if returncode is None:
+            print('Check timeout, please increase the time limit.')
+            return self.compile_success
+        self.compile_success = returncode == 0
+        self.errors = []
+        for line in out.splitlines():
             try:
-                proc.wait(timeout=30)
-            except subprocess.TimeoutExpired:
-                proc.kill()
-            else:
-                self.test_success = proc.returncode == 0
+                msg = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if msg.get('reason') != 'compiler-message' or msg['message']['level'] != 'error':
+                continue
+            message = msg['message']
+            spans = [span for span in message['spans'] if span['is_primary']]
+            self.errors.append({
+                'code': message['code']['code'] if message['code'] else None,
+                'message': message['message'],
+                'file': spans[0]['file_name'] if spans else None,
+                'line': spans[0]['line_start'] if spans else None,
+            })
+        return self.compile_success
+
+    def test(self, doc_only=False, check_first=False) -> bool:
+        '''
+        Runs the target doctest of a library that compiles. By default compilation is
+        decided by `cargo build`, as in the published results, and `cargo test --doc`
+        then builds the library a second time.
+        With `doc_only`, `cargo test --doc` builds the library only once, and compilation
+        succeeded iff it got to the doctests, also when the doctest then times out.
+        This only covers the library, while `cargo build` also builds the binaries of
+        the crate, so compile@k is not comparable with the default.
+        With `check_first`, compilation is decided by `check` and the doctest only
+        runs for code that type-checks.
+        '''
+        cmd = f'cargo test --doc {self.data["lines"][0]}'
+        if check_first:
+            if not self.check():
+                return self.test_success
+            returncode, _, _ = self._cargo(cmd, 'test', self.timeouts['compile'] + self.timeouts['test'])
+            self.test_success = returncode == 0
+            return self.test_success
+        if doc_only:
+            returncode, _, err = self._cargo(cmd, 'test', self.timeouts['compile'] + self.timeouts['test'])
+            # On timeout `err` holds the output so far, so a hanging doctest still counts as compiled.
+            self.compile_success = 'Doc-tests' in err
+        else:
+            self.compile()
+            if not self.compile_success:
+                return self.test_success
+            returncode, _, _ = self._cargo(cmd, 'test', self.timeouts['test'])
+        self.test_success = returncode == 0
         return self.test_success